@@ -0,0 +1,338 @@
+#!/usr/bin/python3
+
+import asyncio
+import contextvars
+import functools
+import itertools
+import json
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from aiohttp import web
+from aiohttp.test_utils import AioHTTPTestCase
+from backend import Calendar, CalendarPool
+from meeting_cache import MeetingCache
+from metrics import METRICS
+from server_common import create_pool, create_batch_executor, configure_metrics, parse_date, parse_window, \
+    parse_meeting_options, parse_meetings, parse_schedule, wants_stream, batch_rows, add_batch, METRICS_CONTENT_TYPE
+
+# Database work runs on two bounded thread pools. Cheap lookups and writes never wait behind
+# meeting computations, which can take much longer for large panels.
+LIGHT_WORKERS = int(os.environ.get('CALENDAR_LIGHT_WORKERS', 4))
+HEAVY_WORKERS = int(os.environ.get('CALENDAR_HEAVY_WORKERS', 2))
+# Number of values sent in every chunk of a streamed response, and of responses streamed at once
+STREAM_CHUNK = 256
+MAX_STREAMS = int(os.environ.get('CALENDAR_MAX_STREAMS', 8))
+
+# Same bodies that flask_restful returns for aborted requests
+NOT_FOUND = {'message': 'The requested URL was not found on the server. '
+                        'If you entered the URL manually please check your spelling and try again.'}
+BAD_REQUEST = {'message': 'The browser (or proxy) sent a request that this server could not understand.'}
+
+
+async def run(request, executor, func, *args):
+    """Runs `func(calendar, *args)` on one of the executors of the application.
+
+    The calendar is lent by the pool of the application for the duration of the call. The call runs in a
+    copy of the current context, so that its metrics are attributed to the current request.
+    """
+    pool = request.app['pool']
+
+    def call():
+        with pool.calendar() as calendar:
+            return func(calendar, *args)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(request.app[executor], contextvars.copy_context().run, call)
+
+
+async def stream(request, executor, func, *args):
+    """Sends the values yielded by `func(calendar, *args)` as a chunked NDJSON response.
+
+    The values are read one chunk at a time, each chunk in its own call on the executor, and the next
+    chunk is only read once the previous one has been sent. Memory use does not depend on the size of the
+    response, and executor threads are not held while a slow client downloads. The calendar (and its open
+    cursor) is held for the whole response instead. At most `MAX_STREAMS` responses are streamed at once,
+    and later ones wait for a free slot without holding a thread or a calendar.
+    """
+    pool = request.app['pool']
+    loop = asyncio.get_running_loop()
+    # Every chunk is read in the same context, so that its metrics are attributed to the current request
+    context = contextvars.copy_context()
+
+    def read_chunk(items):
+        return ''.join(json.dumps(item) + '\n' for item in itertools.islice(items, STREAM_CHUNK))
+
+    response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+    await response.prepare(request)
+    async with request.app['streams']:
+        calendar = await loop.run_in_executor(request.app[executor], pool.acquire)
+        items = context.run(func, calendar, *args)
+        try:
+            while True:
+                data = await loop.run_in_executor(request.app[executor], context.run, read_chunk, items)
+                if not data:
+                    break
+                await response.write(data.encode())
+        finally:
+            # Also reached when the client goes away. Dropping the last reference to the values finalizes the
+            # generators that read them, and their cursor, before the calendar is lent again
+            del items
+            pool.release(calendar)
+    await response.write_eof()
+    return response
+
+
+def reply(retval):
+    """Builds the response for a return value of the backend, as the Flask resources do."""
+    with METRICS.phase('encode'):
+        body = json.dumps(retval)
+    return web.json_response(text=body, status=400 if retval['code'] != 0 else 200)
+
+
+async def get_person(request):
+    retval = await run(request, 'light', Calendar.get_user, request.match_info['user_id'])
+    if retval['data'] != '':
+        return web.json_response({'data': retval['data']})
+    else:
+        return web.json_response(NOT_FOUND, status=404)
+
+
+async def post_person(request):
+    form = await request.post()
+    retval = await run(request, 'light', Calendar.add_user, request.match_info['user_id'], form.get('name'))
+    return reply(retval)
+
+
+async def get_slots(request):
+    try:
+        start, end = parse_window(request.query)
+    except ValueError:
+        return web.json_response(BAD_REQUEST, status=400)
+    fmt = request.query.get('format', 'hours')
+    if wants_stream(request.query):
+        retval = await run(request, 'light', Calendar.check_slots, start, end, fmt)
+        if retval['code'] == 0:
+            return await stream(request, 'heavy', Calendar.iter_slots, request.match_info['user_id'], start, end, fmt)
+        # Same body as the errors of `get_slots`
+        retval['data'] = []
+        return reply(retval)
+    retval = await run(request, 'heavy', Calendar.get_slots, request.match_info['user_id'], start, end, fmt)
+    return reply(retval)
+
+
+async def post_slots(request):
+    form = await request.post()
+    retval = await run(request, 'light', Calendar.add_slots, request.match_info['user_id'],
+                       parse_date(form.get('from')), parse_date(form.get('to')))
+    return reply(retval)
+
+
+async def get_meeting(request):
+    try:
+        start, end = parse_window(request.query)
+        options = parse_meeting_options(request.query)
+    except ValueError:
+        return web.json_response(BAD_REQUEST, status=400)
+    users = request.match_info['user_ids'].split(',')
+    if wants_stream(request.query):
+        retval = await run(request, 'light', functools.partial(Calendar.check_meeting_query, **options),
+                           users[0], users[1:], start, end)
+        if retval['code'] == 0:
+            return await stream(request, 'heavy', functools.partial(Calendar.iter_meeting, **options),
+                                users[0], users[1:], start, end)
+        # Same body as the errors of `organize_meeting`
+        retval['data'] = []
+        return reply(retval)
+    retval = await run(request, 'heavy', functools.partial(Calendar.organize_meeting, **options),
+                       users[0], users[1:], start, end)
+    return reply(retval)
+
+
+async def post_meetings(request):
+    try:
+        meetings, options = parse_meetings(await request.json())
+    except ValueError:
+        return web.json_response(BAD_REQUEST, status=400)
+    retval = await run(request, 'heavy', functools.partial(Calendar.organize_meetings, executor=request.app['batch'],
+                                                           **options), meetings)
+    return reply(retval)
+
+
+async def post_schedule(request):
+    try:
+        meetings, options = parse_schedule(await request.json())
+    except ValueError:
+        return web.json_response(BAD_REQUEST, status=400)
+    retval = await run(request, 'heavy', functools.partial(Calendar.schedule_meetings, executor=request.app['batch'],
+                                                           **options), meetings)
+    return reply(retval)
+
+
+async def post_batch(request):
+    try:
+        body = await request.json()
+    except ValueError:
+        body = None
+    try:
+        people, slots = batch_rows(body)
+    except ValueError:
+        return web.json_response(BAD_REQUEST, status=400)
+    retval = await run(request, 'heavy', add_batch, people, slots)
+    return reply(retval)
+
+
+async def get_cache(request):
+    return web.json_response(request.app['pool'].cache.stats())
+
+
+async def get_metrics(request):
+    return web.Response(body=METRICS.render().encode(), headers={'Content-Type': METRICS_CONTENT_TYPE})
+
+
+@web.middleware
+async def measure(request, handler):
+    """Measures the latency of every request, by route and status."""
+    resource = request.match_info.route.resource
+    started = METRICS.begin('{} {}'.format(request.method, resource.canonical if resource is not None else 'unmatched'))
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as error:
+        status = error.status
+        raise
+    finally:
+        METRICS.end(started, status)
+
+
+async def close_executors(app):
+    for executor in ('light', 'heavy', 'batch'):
+        if app[executor] is not None:
+            app[executor].shutdown(wait=True)
+    app['pool'].close()
+
+
+def create_app(pool=None):
+    """Creates the application.
+
+    Parameters
+    ----------
+    pool : CalendarPool, optional
+        The pool of calendars to use. By default, one is created from the environment, as in `flask_server.py`.
+    """
+    configure_metrics()
+    app = web.Application(middlewares=[measure])
+    # Every executor thread and every streamed response uses at most one calendar at a time
+    app['pool'] = pool if pool is not None else create_pool(LIGHT_WORKERS + HEAVY_WORKERS + MAX_STREAMS)
+    app['streams'] = asyncio.Semaphore(MAX_STREAMS)
+    app['light'] = ThreadPoolExecutor(max_workers=LIGHT_WORKERS, thread_name_prefix='calendar-light')
+    app['heavy'] = ThreadPoolExecutor(max_workers=HEAVY_WORKERS, thread_name_prefix='calendar-heavy')
+    app['batch'] = create_batch_executor()
+    app.on_cleanup.append(close_executors)
+    app.add_routes([web.get('/people/{user_id}', get_person),
+                    web.post('/people/{user_id}', post_person),
+                    web.get('/slots/{user_id}', get_slots),
+                    web.post('/slots/{user_id}', post_slots),
+                    web.get('/meeting/{user_ids}', get_meeting),
+                    web.post('/meetings', post_meetings),
+                    web.post('/schedule', post_schedule),
+                    web.post('/batch', post_batch),
+                    web.get('/cache', get_cache),
+                    web.get('/metrics', get_metrics)])
+    return app
+
+
+class TestCaseServers(AioHTTPTestCase):
+    """Tests that this server answers every request with the same status and body as `flask_server.py`.
+
+    Every request is sent to both servers, each one with its own database, so their databases stay equal.
+    """
+    async def get_application(self):
+        # Imported here, so that starting this server does not create the Flask application
+        import flask_server
+        self.databases = [tempfile.NamedTemporaryFile(delete=False) for _ in range(2)]
+        flask_server.pool = CalendarPool(self.databases[0].name, cache=MeetingCache())
+        self.flask = flask_server.app.test_client()
+        return create_app(CalendarPool(self.databases[1].name, cache=MeetingCache(),
+                                       size=LIGHT_WORKERS + HEAVY_WORKERS + MAX_STREAMS))
+
+    async def asyncTearDown(self):
+        import flask_server
+        await super().asyncTearDown()
+        flask_server.pool.close()
+        flask_server.pool = None
+        for database in self.databases:
+            os.unlink(database.name)
+
+    @staticmethod
+    def decode(content_type, body):
+        if content_type == 'application/x-ndjson':
+            return [json.loads(line) for line in body.splitlines()]
+        return json.loads(body)
+
+    async def compare(self, method, url, **kwargs):
+        """Sends the same request to both servers, and checks that both answers are equal."""
+        expected = self.flask.open(url, method=method, **kwargs)
+        response = await self.client.request(method, url, **kwargs)
+        body = await response.text()
+        self.assertEqual(response.status, expected.status_code, '{} {}'.format(method, url))
+        self.assertEqual(response.content_type, expected.mimetype, '{} {}'.format(method, url))
+        self.assertEqual(self.decode(response.content_type, body),
+                         self.decode(expected.mimetype, expected.get_data(as_text=True)), '{} {}'.format(method, url))
+        return response.status
+
+    async def testPeople(self):
+        self.assertEqual(await self.compare('POST', '/people/manager1', data={'name': 'Manager 1'}), 200)
+        self.assertEqual(await self.compare('POST', '/people/manager1', data={'name': 'Manager 1'}), 400)
+        self.assertEqual(await self.compare('GET', '/people/manager1'), 200)
+        self.assertEqual(await self.compare('GET', '/people/manager2'), 404)
+
+    async def testSlots(self):
+        await self.compare('POST', '/people/manager1', data={'name': 'Manager 1'})
+        self.assertEqual(await self.compare('POST', '/slots/manager1',
+                                            data={'from': '2018-12-12T14:00:00', 'to': '2018-12-12T18:00:00'}), 200)
+        self.assertEqual(await self.compare('POST', '/slots/manager1', data={'from': 'never', 'to': 'ever'}), 400)
+        for query in ('', '?format=ranges', '?stream=1', '?stream=1&format=ranges', '?start=2018-12-12T16:00:00'):
+            self.assertEqual(await self.compare('GET', '/slots/manager1' + query), 200)
+        for query in ('?format=days', '?stream=1&format=days', '?start=never'):
+            self.assertEqual(await self.compare('GET', '/slots/manager1' + query), 400)
+
+    async def testMeeting(self):
+        for user_id in ('manager1', 'manager2', 'interviewee'):
+            await self.compare('POST', '/people/' + user_id, data={'name': user_id})
+            await self.compare('POST', '/slots/' + user_id,
+                               data={'from': '2018-12-12T10:00:00', 'to': '2018-12-12T18:00:00'})
+        for query in ('', '?format=ranges', '?limit=2', '?min_hours=3', '?stream=1', '?stream=1&format=ranges'):
+            self.assertEqual(await self.compare('GET', '/meeting/interviewee,manager1,manager2' + query), 200)
+        for query in ('?limit=0', '?limit=2.5', '?min_hours=x', '?stream=1&format=days'):
+            self.assertEqual(await self.compare('GET', '/meeting/interviewee,manager1' + query), 400)
+        self.assertEqual(await self.compare('GET', '/meeting/interviewee'), 400)
+        self.assertEqual(await self.compare('GET', '/meeting/interviewee?stream=1'), 400)
+
+    async def testMeetings(self):
+        for user_id in ('manager1', 'interviewee'):
+            await self.compare('POST', '/people/' + user_id, data={'name': user_id})
+            await self.compare('POST', '/slots/' + user_id,
+                               data={'from': '2018-12-12T10:00:00', 'to': '2018-12-12T14:00:00'})
+        meetings = [{'interviewee': 'interviewee', 'interviewers': ['manager1']},
+                    {'interviewee': 'interviewee', 'interviewers': []}]
+        self.assertEqual(await self.compare('POST', '/meetings', json={'meetings': meetings[:1], 'format': 'ranges'}),
+                         200)
+        self.assertEqual(await self.compare('POST', '/meetings', json={'meetings': meetings}), 400)
+        for body in ([], {'meetings': meetings, 'limit': 2.5}, {'meetings': meetings, 'min_hours': True}):
+            self.assertEqual(await self.compare('POST', '/meetings', json=body), 400)
+
+    async def testBatch(self):
+        people = [{'user_id': 'manager1', 'name': 'Manager 1'}, {'user_id': 'manager1', 'name': 'Manager 1'}]
+        slots = [{'user_id': 'manager1', 'from': '2018-12-12T14:00:00', 'to': '2018-12-12T16:00:00'},
+                 {'user_id': 'manager2', 'from': '2018-12-12T14:00:00', 'to': '2018-12-12T16:00:00'}]
+        self.assertEqual(await self.compare('POST', '/batch', json={'people': people[:1], 'slots': slots[:1]}), 200)
+        self.assertEqual(await self.compare('POST', '/batch', json={'people': people, 'slots': slots}), 400)
+        for body in ([], {'people': 'manager1'}, {'slots': {}}):
+            self.assertEqual(await self.compare('POST', '/batch', json=body), 400)
+        self.assertEqual(await self.compare('GET', '/slots/manager1'), 200)
+
+
+if __name__ == '__main__':
+    web.run_app(create_app(), port=5000)
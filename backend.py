@@ -1,10 +1,37 @@
 #!/usr/bin/python3
 
+import concurrent.futures
+import contextlib
+import itertools
 import os
+import queue
+import random
 import sqlite3
 import tempfile
+import threading
 import unittest
 from datetime import datetime, timedelta
+from meeting_cache import MeetingCache
+from snapshot import SnapshotLog
+from datecodec import to_utc, to_timestamp, format_hour
+from intervals import SlotSet, sweep_intervals, intersect_panels
+from bitmaps import WEEK_HOURS, range_masks, to_blob, from_blob, intersect_bitmaps
+from scheduler import assign_meetings
+from metrics import METRICS, Metrics
+
+
+def hour_bounds(start, end):
+    """Converts an optional time window into a range of hours since the epoch.
+
+    Returns
+    -------
+    tuple(int, int)
+        The first hour that starts at or after `start`, and the first hour that starts at or after `end`.
+        Missing bounds are replaced by bounds that no date can reach.
+    """
+    hour_from = -(-to_timestamp(start) // 3600) if start is not None else -2**62
+    hour_to = -(-to_timestamp(end) // 3600) if end is not None else 2**62
+    return hour_from, hour_to
 
 
 class Calendar:
@@ -16,7 +43,15 @@ class Calendar:
     SQLite version is new enough to have foreign key support (> 3.6, released in 2009).
 
     Dates are stored as text due to SQLite not having a 'date' type. The format for those strings
-    is the ISO 8601 format (YYYY-MM-DDTHH:MM:SS[.mmmmmm][+HH:MM]).
+    is the ISO 8601 format (YYYY-MM-DDTHH:MM:SS[.mmmmmm][+HH:MM]). Every slot also stores its dates
+    as seconds since the epoch (`ts_from`, `ts_to`), which is what queries actually use: they can be
+    compared and sorted inside SQLite, and read back without parsing.
+
+    The schema version is kept in `PRAGMA user_version`. Opening a database created by an older
+    version of this class upgrades it in place by running the pending entries of `MIGRATIONS`.
+
+    Optionally, reads can be served from an in-memory copy of the database (see `sync_snapshot`),
+    while writes still go to the database file.
     """
     # Templates for all SQL queries
     INIT_DB_SQL1 = "CREATE TABLE IF NOT EXISTS people(" \
@@ -24,30 +59,205 @@ class Calendar:
     INIT_DB_SQL2 = "CREATE TABLE IF NOT EXISTS slots(" \
                    "username TEXT NOT NULL, date_from TEXT NOT NULL, date_to TEXT NOT NULL," \
                    "FOREIGN KEY(username) REFERENCES people(username));"
-    ADD_USER_SQL = "INSERT INTO people VALUES ('{}','{}');"
-    GET_USER_SQL = "SELECT * FROM people WHERE username = '{}';"
-    ADD_SLOT_SQL = "INSERT INTO slots VALUES('{}','{}','{}');"
-    GET_SLOT_SQL = "SELECT * FROM slots WHERE username = '{}';"
+    ADD_USER_SQL = "INSERT INTO people VALUES (?, ?);"
+    GET_USER_SQL = "SELECT * FROM people WHERE username = ?;"
+    FIND_USERS_SQL = "SELECT username FROM people WHERE username IN ({});"
+    ADD_SLOT_SQL = "INSERT INTO slots(username, date_from, date_to, ts_from, ts_to) VALUES(?, ?, ?, ?, ?);"
+    GET_SLOT_SQL = "SELECT ts_from, ts_to FROM slots WHERE username = ? ORDER BY ts_from;"
+    GET_SLOT_WINDOW_SQL = "SELECT ts_from, ts_to FROM slots WHERE username = ? AND ts_from < ? AND ts_to > ? " \
+                          "ORDER BY ts_from;"
+    # The stored slots that may overlap with or touch a range (see `merge_slot`): the last one that starts
+    # before the range, and the ones that start inside it
+    GET_PREVIOUS_SLOT_SQL = "SELECT rowid, ts_from, ts_to FROM slots WHERE username = ? AND ts_from < ? " \
+                            "ORDER BY ts_from DESC LIMIT 1;"
+    GET_STARTING_SQL = "SELECT rowid, ts_from, ts_to FROM slots WHERE username = ? AND ts_from >= ? AND ts_from < ?;"
+    DELETE_SLOT_SQL = "DELETE FROM slots WHERE rowid = ?;"
+    COUNT_SLOTS_SQL = "SELECT count(*) FROM slots;"
+    GET_SORTED_SLOTS_SQL = "SELECT username, ts_from, ts_to FROM slots ORDER BY username, ts_from;"
+    DELETE_ALL_SLOTS_SQL = "DELETE FROM slots;"
 
-    def __init__(self, database):
+    # Optional index with one bitmap of available hours per user and week (see `build_bitmap_index`)
+    HAS_BITMAPS_SQL = "SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = 'availability';"
+    INIT_BITMAPS_SQL = "CREATE TABLE availability(" \
+                       "username TEXT NOT NULL, week INTEGER NOT NULL, bits BLOB NOT NULL," \
+                       "PRIMARY KEY(username, week), FOREIGN KEY(username) REFERENCES people(username)) WITHOUT ROWID;"
+    DROP_BITMAPS_SQL = "DROP TABLE IF EXISTS availability;"
+    GET_BITMAP_SQL = "SELECT bits FROM availability WHERE username = ? AND week = ?;"
+    GET_BITMAPS_SQL = "SELECT week, bits FROM availability WHERE username = ? AND week >= ? AND week < ?;"
+    SET_BITMAP_SQL = "INSERT OR REPLACE INTO availability VALUES (?, ?, ?);"
+    GET_ALL_SLOTS_SQL = "SELECT username, ts_from, ts_to FROM slots;"
+
+    # Copying the rows of a user from the database into an in-memory snapshot (see `sync_snapshot`)
+    SNAPSHOT_TABLES = ('people', 'slots', 'availability')
+    ATTACH_DISK_SQL = "ATTACH DATABASE ? AS disk;"
+    DELETE_USER_SQL = "DELETE FROM main.{0} WHERE username = ?;"
+    COPY_USER_SQL = "INSERT INTO main.{0} SELECT * FROM disk.{0} WHERE username = ?;"
+    HAS_TABLE_SQL = "SELECT count(*) FROM main.sqlite_master WHERE type = 'table' AND name = ?;"
+    COUNT_CHANGE_SQL = "UPDATE changes SET counter = counter + 1;"
+    GET_CHANGES_SQL = "SELECT counter FROM changes;"
+
+    # Formats in which slots can be returned: one entry per hour, or merged [from, to) ranges
+    FORMATS = ('hours', 'ranges')
+
+    # Schema migrations. Entry `i` upgrades a database from version `i` to version `i+1`
+    MIGRATIONS = [
+        # Version 1: epoch columns for every slot, and an index that covers the slot queries
+        ["ALTER TABLE slots ADD COLUMN ts_from INTEGER;",
+         "ALTER TABLE slots ADD COLUMN ts_to INTEGER;",
+         "UPDATE slots SET ts_from = CAST(strftime('%s', date_from) AS INTEGER),"
+         "                 ts_to = CAST(strftime('%s', date_to) AS INTEGER);",
+         "CREATE INDEX IF NOT EXISTS slots_by_user ON slots(username, ts_from, ts_to);"],
+        # Version 2: a counter of the transactions that changed any data (see `count_change`)
+        ["CREATE TABLE IF NOT EXISTS changes(counter INTEGER NOT NULL);",
+         "INSERT INTO changes SELECT 0 WHERE NOT EXISTS (SELECT * FROM changes);"],
+    ]
+
+    def __init__(self, database, pragmas=None, init_schema=True, cache=None, metrics=None, snapshot=None,
+                 check_same_thread=True):
         """Initializes the backend.
 
         Parameters
         ----------
         database : str
             A filename with the database connection string.
+        pragmas : dict, optional
+            SQLite pragmas to set on the connection, such as `{'journal_mode': 'wal', 'synchronous': 'normal'}`.
+            They are applied in order, before anything else is done with the database.
+        init_schema : bool, optional
+            Whether to create the tables and upgrade the schema. This can be skipped when the schema is known
+            to be up to date, e.g. for all but the first connection of a `CalendarPool`.
+        cache : MeetingCache, optional
+            A cache for the `SlotSet` results of `meeting_slots`. It can be shared by several instances, as long
+            as all the writes to the database go through one of them.
+        metrics : Metrics, optional
+            Where the time spent in every phase of an operation is reported. By default, the metrics of
+            the process (`metrics.METRICS`), which are disabled unless a server enables them.
+        snapshot : SnapshotLog, optional
+            If given, the database is copied into memory and reads are served from that copy, which is
+            kept up to date with the changes in the log. It can be shared by several instances, as long
+            as all of them record their writes in it. The database must be a file.
+        check_same_thread : bool, optional
+            Whether to only allow the thread that created the calendar to use it, as in `sqlite3.connect`.
+            A calendar that is used by several threads, such as the ones lent by a `CalendarPool`, must
+            still be used by one thread at a time.
+        """
+        self.check_same_thread = check_same_thread
+        self.database = database
+        self.cache = cache
+        self.snapshot = snapshot
+        self.metrics = metrics if metrics is not None else METRICS
+        with self.metrics.phase('connect'):
+            # Open the SQLite database
+            self.conn = sqlite3.connect(database, check_same_thread=check_same_thread)
+            # Allow to refer to results via column name rather than just index
+            self.conn.row_factory = sqlite3.Row
+            cursor = self.conn.cursor()
+            for name, value in (pragmas or {}).items():
+                cursor.execute("PRAGMA {} = {}".format(name, value))
+            # Enables foreign keys, if possible
+            cursor.execute("PRAGMA foreign_keys = ON")
+            if init_schema:
+                # If the database is empty, we create the required tables
+                cursor.execute(self.INIT_DB_SQL1)
+                cursor.execute(self.INIT_DB_SQL2)
+                self.conn.commit()
+                self.upgrade_schema()
+        # Connection used for reads: the database itself, or its in-memory snapshot
+        self.reads = self.conn
+        # Number of cursors of `iter_slot_ranges` that are still open
+        self.open_cursors = 0
+        if snapshot is not None:
+            with self.metrics.phase('snapshot'):
+                self.reads = self.open_snapshot()
+
+    def close(self):
+        """Closes the connection to the database."""
+        if self.reads is not self.conn:
+            self.reads.close()
+        self.conn.close()
+
+    def open_snapshot(self):
+        """Copies the database into a new in-memory database, and returns a connection to it.
+
+        The database file is attached to the copy as `disk`, so that the rows of a user can be copied
+        again with a single statement.
+        """
+        # Read before copying, so that the changes committed during the copy are applied again later
+        self.snapshot_change = self.conn.execute(self.GET_CHANGES_SQL).fetchone()[0]
+        self.checked_at = self.snapshot.clock()
+        reads = sqlite3.connect(':memory:', check_same_thread=self.check_same_thread)
+        reads.row_factory = sqlite3.Row
+        self.conn.backup(reads)
+        reads.execute(self.ATTACH_DISK_SQL, (self.database,))
+        return reads
+
+    def sync_snapshot(self):
+        """Brings the in-memory snapshot up to date with the database.
+
+        The rows of the users modified since the last sync, according to the snapshot log, are copied
+        again from the database. The whole database is copied again instead if some of the changes since
+        the last sync are not in the log. That happens when another process changed the database, which
+        is noticed as soon as this process records a later change, or when the change counter of the
+        database is read, at most once every `refresh` seconds of the log.
+
+        Notes
+        -----
+        Nothing is done while `iter_slot_ranges` has an open cursor, so that every cursor of a read (such
+        as the ones of every participant of a meeting) sees the same copy until it is closed.
+        """
+        if self.open_cursors > 0:
+            return
+        latest = None
+        if self.snapshot.refresh is not None and self.snapshot.clock() - self.checked_at >= self.snapshot.refresh:
+            self.checked_at = self.snapshot.clock()
+            latest = self.conn.execute(self.GET_CHANGES_SQL).fetchone()[0]
+        change, users = self.snapshot.since(self.snapshot_change, latest)
+        if users is None:
+            self.snapshot.count('reloads')
+            previous = self.reads
+            self.reads = self.open_snapshot()
+            previous.close()
+            return
+        if users:
+            self.snapshot.count('updates')
+            tables = [table for table in self.SNAPSHOT_TABLES
+                      if self.reads.execute(self.HAS_TABLE_SQL, (table,)).fetchone()[0] > 0]
+            with self.reads:
+                for user_id in users:
+                    for table in tables:
+                        self.reads.execute(self.DELETE_USER_SQL.format(table), (user_id,))
+                        self.reads.execute(self.COPY_USER_SQL.format(table), (user_id,))
+        self.snapshot_change = change
+
+    def reader(self):
+        """Returns the connection that reads are served from, bringing the snapshot up to date first if there is one."""
+        if self.snapshot is not None:
+            with self.metrics.phase('snapshot'):
+                self.sync_snapshot()
+        return self.reads
+
+    def upgrade_schema(self):
+        """Brings the database schema up to date.
+
+        Every pending migration is run inside a single transaction, so a database is never left
+        halfway between two versions. The transaction takes the write lock before the version is read
+        again, so that processes opening an old database at the same time only upgrade it once.
         """
-        # Open the SQLite database
-        self.conn = sqlite3.connect(database)
-        # Allow to refer to results via column name rather than just index
-        self.conn.row_factory = sqlite3.Row
         cursor = self.conn.cursor()
-        # Enables foreign keys, if possible
-        cursor.execute("PRAGMA foreign_keys = ON")
-        # If the database is empty, we create the required tables
-        cursor.execute(self.INIT_DB_SQL1)
-        cursor.execute(self.INIT_DB_SQL2)
-        self.conn.commit()
+        version = cursor.execute("PRAGMA user_version").fetchone()[0]
+        if version < len(self.MIGRATIONS):
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                # Another process may have upgraded the database while this one waited for the lock
+                version = cursor.execute("PRAGMA user_version").fetchone()[0]
+                for migration in self.MIGRATIONS[version:]:
+                    for statement in migration:
+                        cursor.execute(statement)
+                cursor.execute("PRAGMA user_version = {:d}".format(len(self.MIGRATIONS)))
+                self.conn.commit()
+            except sqlite3.Error:
+                self.conn.rollback()
+                raise
 
     def add_user(self, user_id, name):
         """Adds a new user to the database.
@@ -68,8 +278,11 @@ class Calendar:
         cursor = self.conn.cursor()
         retval = {'code': 0, 'desc': 'Operation successful'}
         try:
-            cursor.execute(self.ADD_USER_SQL.format(user_id, name))
-            self.conn.commit()
+            with self.metrics.phase('sql'):
+                cursor.execute(self.ADD_USER_SQL, (user_id, name))
+                change = self.count_change()
+                self.conn.commit()
+            self.touch(user_id, change)
         except sqlite3.IntegrityError:
             retval['code'] = 1
             retval['desc'] = 'Cannot add user: user already exists'
@@ -90,10 +303,11 @@ class Calendar:
             value (0 = success), `desc` is a human-readable explanation of the return value, and `data` is the
             requested data (namely, the user name).
         """
-        cursor = self.conn.cursor()
+        cursor = self.reader().cursor()
         retval = {'code': 0, 'desc': 'Operation successful', 'data': ""}
-        for row in cursor.execute(self.GET_USER_SQL.format(user_id)):
-            retval['data'] = row['name']
+        with self.metrics.phase('sql'):
+            for row in cursor.execute(self.GET_USER_SQL, (user_id,)):
+                retval['data'] = row['name']
         return retval
 
     def add_slots(self, user_id, slot_from, slot_to):
@@ -121,35 +335,407 @@ class Calendar:
         This operation will add_slots slots in the range [slot_from, slot_to). That is: if the user
         is willing to start the meeting anytime from 16:00 to 20:00, then `slot_to` should
         have a value of 21:00.
+
+        The new slot is merged with the stored slots of the user that overlap with it or are adjacent to it,
+        so every user keeps one row per disjoint block of available hours.
+        """
+        retval = self.check_slot(user_id, slot_from, slot_to)
+        if retval['code'] == 0:
+            # Add the new slot
+            try:
+                with self.metrics.phase('sql'):
+                    row = self.merge_slot(user_id, *self.slot_hours(slot_from, slot_to))
+                    self.update_bitmaps([row])
+                    change = self.count_change()
+                    self.conn.commit()
+                self.touch(user_id, change)
+            except sqlite3.IntegrityError:
+                self.conn.rollback()
+                retval['code'] = 3
+                retval['desc'] = 'Cannot add slot: integrity error'
+        return retval
+
+    def count_change(self):
+        """Increments the change counter of the database, and returns its new value.
+
+        Must be called inside every transaction that changes any data, so that snapshots in other processes
+        notice it (see `sync_snapshot`).
+        """
+        self.conn.execute(self.COUNT_CHANGE_SQL)
+        return self.conn.execute(self.GET_CHANGES_SQL).fetchone()[0]
+
+    def touch(self, user_id, change):
+        """Records the change of a user in the snapshot log, and invalidates their cached meetings.
+
+        Must be called after any change to their data is committed, with the value returned by `count_change`
+        inside that transaction.
+        """
+        # The change must be in the log before the cache entries are invalidated, otherwise a query in between
+        # could read the old snapshot and cache its result under the new versions of the user
+        if self.snapshot is not None:
+            self.snapshot.record(user_id, change)
+        if self.cache is not None:
+            self.cache.touch(user_id)
+
+    @staticmethod
+    def check_slot(user_id, slot_from, slot_to):
+        """Validates the parameters of a new slot.
+
+        Returns
+        -------
+        dict
+            A dictionary containing a pair of fields, `code` and `desc`, with the same values returned by
+            `add_slots` for wrong parameters.
         """
         retval = {'code': 0, 'desc': 'Operation successful'}
         if not(isinstance(user_id, str) and isinstance(slot_from, datetime) and isinstance(slot_to, datetime)):
             retval['code'] = 1
             retval['desc'] = 'Error in add_slots: parameters of wrong type'
-        elif (slot_to - slot_from).total_seconds() <= 0:
+            return retval
+        # The range is empty if it does not contain a whole hour once truncated
+        hour_from, hour_to = Calendar.slot_hours(slot_from, slot_to)
+        if hour_to <= hour_from:
             retval['code'] = 2
             retval['desc'] = 'Error in add_slots: empty range'
-        else:
-            # Remove minutes, seconds, and microseconds from the slots
-            slot_from.replace(minute=0, second=0, microsecond=0)
-            slot_to.replace(minute=0, second=0, microsecond=0)
-            # Add the new slot
-            cursor = self.conn.cursor()
-            try:
-                cursor.execute(self.ADD_SLOT_SQL.format(user_id, slot_from.isoformat(), slot_to.isoformat()))
-                self.conn.commit()
-            except sqlite3.IntegrityError:
-                retval['code'] = 3
-                retval['desc'] = 'Cannot add slot: integrity error'
         return retval
 
-    def get_slots(self, user_id):
+    @staticmethod
+    def slot_hours(slot_from, slot_to):
+        """Converts the dates of a slot into hours since the epoch, removing minutes, seconds, and microseconds.
+
+        Dates are truncated once converted to UTC, so that zones with offsets that are not whole hours are
+        truncated the same way as every query.
+        """
+        return to_timestamp(slot_from) // 3600, to_timestamp(slot_to) // 3600
+
+    @staticmethod
+    def slot_row(user_id, hour_from, hour_to):
+        """Returns the parameters of `ADD_SLOT_SQL` for a range of hours [hour_from, hour_to)."""
+        return user_id, format_hour(hour_from), format_hour(hour_to), hour_from * 3600, hour_to * 3600
+
+    def merge_slot(self, user_id, hour_from, hour_to):
+        """Stores a range of hours, merged with the stored slots of the user that overlap with it or are adjacent to it.
+
+        The merged slots are replaced by a single row. Must be called inside a transaction, since it deletes rows
+        before inserting the new one.
+
+        Returns
+        -------
+        tuple
+            The parameters of `ADD_SLOT_SQL` for the inserted row.
+        """
+        # Stored slots are disjoint, so only the last one that starts before the range can reach it. Both queries
+        # are range scans of the index, so the cost does not depend on the number of slots of the user. Stored
+        # dates may not be whole hours in older databases, so they are compared once truncated.
+        ts_from, ts_to = hour_from * 3600, (hour_to + 1) * 3600
+        rows = self.conn.execute(self.GET_STARTING_SQL, (user_id, ts_from, ts_to)).fetchall()
+        previous = self.conn.execute(self.GET_PREVIOUS_SLOT_SQL, (user_id, ts_from)).fetchone()
+        if previous is not None and previous['ts_to'] >= ts_from:
+            rows.append(previous)
+        rowids = []
+        for row in rows:
+            hour_from = min(hour_from, row['ts_from'] // 3600)
+            hour_to = max(hour_to, row['ts_to'] // 3600)
+            rowids.append((row['rowid'],))
+        self.conn.executemany(self.DELETE_SLOT_SQL, rowids)
+        row = self.slot_row(user_id, hour_from, hour_to)
+        self.conn.execute(self.ADD_SLOT_SQL, row)
+        return row
+
+    def find_users(self, user_ids):
+        """Returns which of the given user ids exist in the database.
+
+        Parameters
+        ----------
+        user_ids : iterable of str
+            The IDs to look for.
+
+        Returns
+        -------
+        set(str)
+            The subset of `user_ids` that belong to existing users.
+        """
+        user_ids = list(user_ids)
+        found = set()
+        cursor = self.conn.cursor()
+        # SQLite limits the number of parameters of a single query
+        for i in range(0, len(user_ids), 500):
+            chunk = user_ids[i:i+500]
+            sql = self.FIND_USERS_SQL.format(', '.join('?' * len(chunk)))
+            found.update(row['username'] for row in cursor.execute(sql, chunk))
+        return found
+
+    def add_users_bulk(self, users):
+        """Adds many users to the database in a single transaction.
+
+        Parameters
+        ----------
+        users : iterable of (str, str)
+            Pairs of (user_id, name) for the new users.
+
+        Returns
+        -------
+        dict
+            A dictionary containing the fields `code`, `desc`, `added`, and `errors`. `code` is the return value
+            (0 = every user was added, 1 = some users were rejected), `desc` is a human-readable explanation of the
+            return value, `added` is the number of users added, and `errors` is a list with one dictionary per
+            rejected user. Each of those dictionaries has the fields `index` (the position of the user in `users`),
+            `code` and `desc`, with the same meaning as the values returned by `add_user`.
+
+        Notes
+        -----
+        Valid users are added even if other users in the same call are rejected.
+        """
+        retval = {'code': 0, 'desc': 'Operation successful', 'added': 0, 'errors': []}
+        rows = []
+        indices = []
+        for index, user in enumerate(users):
+            if not (isinstance(user, (tuple, list)) and len(user) == 2 and isinstance(user[0], str)):
+                retval['errors'].append({'index': index, 'code': 2, 'desc': 'Cannot add user: wrong parameters'})
+            else:
+                rows.append((user[0], user[1]))
+                indices.append(index)
+        # Users that already exist, or that appear twice in the same call, are rejected
+        seen = self.find_users(set(row[0] for row in rows))
+        valid_rows = []
+        for index, row in zip(indices, rows):
+            if row[0] in seen:
+                retval['errors'].append({'index': index, 'code': 1, 'desc': 'Cannot add user: user already exists'})
+            else:
+                seen.add(row[0])
+                valid_rows.append(row)
+        retval['errors'].sort(key=lambda error: error['index'])
+        self.insert_bulk(lambda rows: self.conn.executemany(self.ADD_USER_SQL, rows), valid_rows, retval)
+        return retval
+
+    def add_slots_bulk(self, slots):
+        """Adds many slots to the database in a single transaction.
+
+        Parameters
+        ----------
+        slots : iterable of (str, datetime, datetime)
+            Triples of (user_id, slot_from, slot_to), with the same meaning as the parameters of `add_slots`.
+
+        Returns
+        -------
+        dict
+            A dictionary containing the fields `code`, `desc`, `added`, and `errors`. `code` is the return value
+            (0 = every slot was added, 1 = some slots were rejected), `desc` is a human-readable explanation of the
+            return value, `added` is the number of slots added, and `errors` is a list with one dictionary per
+            rejected slot. Each of those dictionaries has the fields `index` (the position of the slot in `slots`),
+            `code` and `desc`, with the same meaning as the values returned by `add_slots`.
+
+        Notes
+        -----
+        Valid slots are added even if other slots in the same call are rejected.
+        """
+        retval = {'code': 0, 'desc': 'Operation successful', 'added': 0, 'errors': []}
+        rows = []
+        indices = []
+        for index, slot in enumerate(slots):
+            if not (isinstance(slot, (tuple, list)) and len(slot) == 3):
+                check = self.check_slot(None, None, None)
+            else:
+                check = self.check_slot(*slot)
+            if check['code'] != 0:
+                retval['errors'].append({'index': index, 'code': check['code'], 'desc': check['desc']})
+            else:
+                rows.append((slot[0],) + self.slot_hours(slot[1], slot[2]))
+                indices.append(index)
+        # Slots of users that do not exist would violate the foreign key
+        existing = self.find_users(set(row[0] for row in rows))
+        valid_rows = []
+        for index, row in zip(indices, rows):
+            if row[0] not in existing:
+                retval['errors'].append({'index': index, 'code': 3, 'desc': 'Cannot add slot: integrity error'})
+            else:
+                valid_rows.append(row)
+        retval['errors'].sort(key=lambda error: error['index'])
+        self.insert_bulk(self.merge_slots, valid_rows, retval)
+        return retval
+
+    def merge_slots(self, rows):
+        """Stores many ranges of hours, given as (user_id, hour_from, hour_to), merging them as `merge_slot` does.
+
+        The new ranges of every user are merged among themselves first, and then with the stored ones.
+        Must be called inside a transaction.
+        """
+        merged = []
+        for user_id, ranges in itertools.groupby(sorted(rows), key=lambda row: row[0]):
+            for hour_from, hour_to in SlotSet.from_sorted(row[1:] for row in ranges):
+                merged.append(self.merge_slot(user_id, hour_from, hour_to))
+        self.update_bitmaps(merged)
+
+    def compact(self):
+        """Merges the overlapping and adjacent slots of every user, for databases written by older versions.
+
+        Slots are truncated to whole hours, and every user is left with one row per disjoint block of available
+        hours. Everything is rewritten in a single transaction.
+
+        Returns
+        -------
+        dict
+            A dictionary containing the fields `code`, `desc`, `before`, and `after`. `code` is the return value
+            (0 = success), `desc` is a human-readable explanation of the return value, and `before` and `after`
+            are the number of stored slots before and after the operation.
+        """
+        retval = {'code': 0, 'desc': 'Operation successful', 'before': 0, 'after': 0}
+        with self.conn:
+            retval['before'] = self.conn.execute(self.COUNT_SLOTS_SQL).fetchone()[0]
+            rows = []
+            for user_id, slots in itertools.groupby(self.conn.execute(self.GET_SORTED_SLOTS_SQL),
+                                                    key=lambda row: row['username']):
+                ranges = SlotSet.from_sorted((row['ts_from'] // 3600, row['ts_to'] // 3600) for row in slots)
+                rows.extend(self.slot_row(user_id, hour_from, hour_to) for hour_from, hour_to in ranges)
+            self.conn.execute(self.DELETE_ALL_SLOTS_SQL)
+            self.conn.executemany(self.ADD_SLOT_SQL, rows)
+            change = self.count_change()
+        retval['after'] = len(rows)
+        for user_id in set(row[0] for row in rows):
+            self.touch(user_id, change)
+        return retval
+
+    def insert_bulk(self, write, rows, retval):
+        """Writes validated rows in a single transaction, and updates the return value of a bulk operation.
+
+        `write` is called with the rows inside the transaction. The first field of every row must be a user ID.
+        """
+        try:
+            with self.metrics.phase('sql'), self.conn:
+                write(rows)
+                change = self.count_change()
+            retval['added'] = len(rows)
+            for user_id in set(row[0] for row in rows):
+                self.touch(user_id, change)
+        except sqlite3.IntegrityError:
+            retval['code'] = 3
+            retval['desc'] = 'Cannot add rows: integrity error'
+            return
+        if len(retval['errors']) > 0:
+            retval['code'] = 1
+            retval['desc'] = 'Some rows could not be added'
+
+    def has_bitmap_index(self):
+        """Returns whether the database has the optional bitmap index (see `build_bitmap_index`)."""
+        return self.reader().execute(self.HAS_BITMAPS_SQL).fetchone()[0] > 0
+
+    def build_bitmap_index(self):
+        """Builds (or rebuilds) the optional bitmap index of available hours.
+
+        The index stores one bitmap per user and week, with one bit per hour, next to the `slots` table.
+        Once it exists, every write keeps it up to date, and `meeting_slots` intersects the bitmaps of the
+        participants instead of their slots.
+
+        Returns
+        -------
+        dict
+            A dictionary containing a pair of fields, `code` and `desc`. `code` is the return value (0 = success),
+            and `desc` is a human-readable explanation of the return value.
+        """
+        retval = {'code': 0, 'desc': 'Operation successful'}
+        bitmaps = dict()
+        for row in self.conn.execute(self.GET_ALL_SLOTS_SQL):
+            for week, mask in range_masks(row['ts_from'] // 3600, row['ts_to'] // 3600).items():
+                key = (row['username'], week)
+                bitmaps[key] = bitmaps.get(key, 0) | mask
+        with self.conn:
+            self.conn.execute(self.DROP_BITMAPS_SQL)
+            self.conn.execute(self.INIT_BITMAPS_SQL)
+            self.conn.executemany(self.SET_BITMAP_SQL,
+                                  ((user_id, week, to_blob(bits)) for (user_id, week), bits in bitmaps.items()))
+            change = self.count_change()
+        if self.snapshot is not None:
+            # The snapshots do not have the new table yet
+            self.snapshot.record(None, change)
+        return retval
+
+    def update_bitmaps(self, rows):
+        """Adds new slots to the bitmap index, if the database has one.
+
+        Must be called inside the transaction that inserts the slots. `rows` are the parameters of `ADD_SLOT_SQL`.
+        """
+        if self.conn.execute(self.HAS_BITMAPS_SQL).fetchone()[0] == 0:
+            return
+        bitmaps = dict()
+        for row in rows:
+            for week, mask in range_masks(row[3] // 3600, row[4] // 3600).items():
+                key = (row[0], week)
+                bitmaps[key] = bitmaps.get(key, 0) | mask
+        for (user_id, week), bits in bitmaps.items():
+            stored = self.conn.execute(self.GET_BITMAP_SQL, (user_id, week)).fetchone()
+            if stored is not None:
+                bits |= from_blob(stored['bits'])
+            self.conn.execute(self.SET_BITMAP_SQL, (user_id, week, to_blob(bits)))
+
+    def bitmap_weeks(self, user_id, start=None, end=None):
+        """Returns the weekly bitmaps of a user that overlap with a time window, indexed by week."""
+        hour_from, hour_to = hour_bounds(start, end)
+        with self.metrics.phase('sql'):
+            rows = self.reader().execute(self.GET_BITMAPS_SQL, (user_id, hour_from // WEEK_HOURS,
+                                                                (hour_to - 1) // WEEK_HOURS + 1))
+            bitmaps = {row['week']: from_blob(row['bits']) for row in rows}
+        self.metrics.count('rows', len(bitmaps))
+        return bitmaps
+
+    @staticmethod
+    def check_window(start, end):
+        """Validates an optional time window.
+
+        Parameters
+        ----------
+        start : datetime or None
+            The beginning of the window, or None if the window is open at the start.
+        end : datetime or None
+            The end of the window, or None if the window is open at the end.
+
+        Returns
+        -------
+        bool
+            True if the window is valid, False otherwise.
+        """
+        for date in (start, end):
+            if date is not None and not isinstance(date, datetime):
+                return False
+        return start is None or end is None or to_utc(start) < to_utc(end)
+
+    def query_slots(self, user_id, start=None, end=None):
+        """Returns a cursor over the stored slots of a user that overlap with a time window.
+
+        Parameters
+        ----------
+        user_id : str
+            The ID of the user whose slots will be queried.
+        start : datetime, optional
+            Slots that end at or before this date are not returned.
+        end : datetime, optional
+            Slots that start at or after this date are not returned.
+
+        Returns
+        -------
+        sqlite3.Cursor
+            A cursor over rows with the fields `ts_from` and `ts_to`, sorted by `ts_from`.
+        """
+        cursor = self.reader().cursor()
+        if start is None and end is None:
+            return cursor.execute(self.GET_SLOT_SQL, (user_id,))
+        # An open end of the window is replaced by a bound that no date can reach
+        ts_from = to_timestamp(start) if start is not None else -2**62
+        ts_to = to_timestamp(end) if end is not None else 2**62
+        return cursor.execute(self.GET_SLOT_WINDOW_SQL, (user_id, ts_to, ts_from))
+
+    def get_slots(self, user_id, start=None, end=None, fmt='hours'):
         """Returns the available slots for the given user id.
 
         Parameters
         ----------
         user_id : str
             The ID of the user whose slots will be queried.
+        start : datetime, optional
+            If given, only slots that start at or after this date are returned.
+        end : datetime, optional
+            If given, only slots that start before this date are returned.
+        fmt : str, optional
+            The format of the returned slots, either 'hours' (the default) or 'ranges'.
 
         Returns
         -------
@@ -157,20 +743,199 @@ class Calendar:
             A dictionary containing a triple of fields: `code`, `desc`, and `data`.
             `code` is the return value for the operation (0 = success), `desc` is a human-readable explanation of the
             return value, and `data` is a set of returned time slots.
-            Each hour in a time slot is returned as its own slot.
+            With the 'hours' format, each hour in a time slot is returned as its own slot. With the 'ranges'
+            format, the slots are merged into sorted, disjoint [from, to) pairs.
         """
-        retval = {'code': 0, 'desc': 'Operation successful', 'data': []}
-        cursor = self.conn.cursor()
-        for row in cursor.execute(self.GET_SLOT_SQL.format(user_id)):
-            date_from = datetime.strptime(row['date_from'], "%Y-%m-%dT%H:%M:%S")
-            date_to = datetime.strptime(row['date_to'], "%Y-%m-%dT%H:%M:%S")
-            while date_from < date_to:
-                retval['data'].append(date_from.isoformat())
-                date_from += timedelta(seconds=3600)
-        self.conn.commit()
+        retval = self.check_slots(start, end, fmt)
+        retval['data'] = []
+        if retval['code'] == 0:
+            ranges = self.slot_set(user_id, start, end)
+            with self.metrics.phase('expand'):
+                retval['data'] = list(self.format_slots(ranges, fmt))
+            self.metrics.count('slots', len(retval['data']))
+        return retval
+
+    def check_slots(self, start, end, fmt):
+        """Validates the parameters of a slot listing.
+
+        Returns
+        -------
+        dict
+            A dictionary containing a pair of fields, `code` and `desc`, with the same values returned by
+            `get_slots` for wrong parameters.
+        """
+        retval = {'code': 0, 'desc': 'Operation successful'}
+        if not self.check_window(start, end):
+            retval['code'] = 1
+            retval['desc'] = 'Wrong time window'
+        elif fmt not in self.FORMATS:
+            retval['code'] = 2
+            retval['desc'] = 'Unknown format'
         return retval
 
-    def organize_meeting(self, interviewee, interviewers):
+    def iter_slots(self, user_id, start=None, end=None, fmt='hours'):
+        """Iterates over the available slots of a user, in the same format as `get_slots`.
+
+        The rows are read from the database as the slots are consumed, so the memory used does not depend
+        on the size of the calendar. The parameters are assumed to be valid (see `check_slots`).
+        """
+        return self.format_slots(self.iter_slot_ranges(user_id, start, end), fmt)
+
+    def slot_set(self, user_id, start=None, end=None):
+        """Returns the available hours of a user as a `SlotSet`.
+
+        Parameters
+        ----------
+        user_id : str
+            The ID of the user whose slots will be queried.
+        start : datetime, optional
+            If given, only hours that start at or after this date are returned.
+        end : datetime, optional
+            If given, only hours that start before this date are returned.
+
+        Returns
+        -------
+        SlotSet
+            The available hours of the user. The window is assumed to be valid (see `check_window`).
+        """
+        with self.metrics.phase('sql'):
+            return SlotSet.from_sorted(self.iter_slot_ranges(user_id, start, end))
+
+    def iter_slot_ranges(self, user_id, start=None, end=None):
+        """Iterates over the available hours of a user, as sorted and disjoint ranges of hours since the epoch.
+
+        The parameters are the same as in `slot_set`. The rows are read from the database as the ranges are
+        consumed, so a caller that stops early never reads the rest of the user's slots.
+
+        Yields
+        ------
+        tuple(int, int)
+            Ranges of hours [from, to). Overlapping and adjacent slots are merged.
+        """
+        hour_from, hour_to = hour_bounds(start, end)
+        current_from = current_to = None
+        rows = 0
+        cursor = self.query_slots(user_id, start, end)
+        self.open_cursors += 1
+        try:
+            for row in cursor:
+                rows += 1
+                range_from = max(row['ts_from'] // 3600, hour_from)
+                range_to = min(row['ts_to'] // 3600, hour_to)
+                if range_from >= range_to:
+                    continue
+                if current_to is not None and range_from <= current_to:
+                    current_to = max(current_to, range_to)
+                else:
+                    if current_to is not None:
+                        yield current_from, current_to
+                    current_from, current_to = range_from, range_to
+            if current_to is not None:
+                yield current_from, current_to
+        finally:
+            # Also reached when the caller stops early
+            self.open_cursors -= 1
+            self.metrics.count('rows', rows)
+
+    def check_meeting(self, interviewee, interviewers, start, end):
+        """Validates the parameters of a meeting.
+
+        Returns
+        -------
+        dict
+            A dictionary containing a pair of fields, `code` and `desc`, with the error codes described in
+            `meeting_slots`.
+        """
+        retval = {'code': 0, 'desc': 'Operation successful'}
+        if not isinstance(interviewers, list) or not all(isinstance(person, str) for person in interviewers):
+            retval['code'] = 1
+            retval['desc'] = 'Wrong list of interviewers'
+        elif not isinstance(interviewee, str):
+            retval['code'] = 2
+            retval['desc'] = 'Wrong interviewee name'
+        elif len(interviewers) == 0:
+            retval['code'] = 3
+            retval['desc'] = 'Missing at least one interviewer'
+        elif not self.check_window(start, end):
+            retval['code'] = 4
+            retval['desc'] = 'Wrong time window'
+        return retval
+
+    def iter_meeting_ranges(self, interviewee, interviewers, start=None, end=None, min_hours=1):
+        """Iterates over the ranges of hours in which all the given people are available.
+
+        Every participant's slots are read in order from the database while the ranges are consumed, so
+        finding the first ranges only reads the slots up to them, regardless of the size of the calendars.
+        The parameters are assumed to be valid (see `check_meeting`).
+
+        Parameters
+        ----------
+        min_hours : int, optional
+            Only ranges of at least this many consecutive hours are returned.
+
+        Yields
+        ------
+        tuple(int, int)
+            Sorted and disjoint ranges of hours since the epoch, in the form [from, to).
+        """
+        people = [self.iter_slot_ranges(person, start, end) for person in set(interviewers+[interviewee])]
+        for range_from, range_to in sweep_intervals(people):
+            if range_to - range_from >= min_hours:
+                yield range_from, range_to
+
+    def meeting_slots(self, interviewee, interviewers, start=None, end=None):
+        """Calculates the hours in which all the given people are available.
+
+        Parameters
+        ----------
+        interviewee : str
+            ID of the user that must be in the meeting.
+        interviewers : list(str)
+            List of IDs for everyone else who should be in the meeting.
+        start : datetime, optional
+            If given, only hours that start at or after this date are considered.
+        end : datetime, optional
+            If given, only hours that start before this date are considered.
+
+        Returns
+        -------
+        dict
+            A dictionary containing a triple of fields: `code`, `desc`, and `data`.
+            `code` is the return value for the operation (0 = success), `desc` is a human-readable explanation
+            of the return value, and `data` is a `SlotSet` with the common hours. It must not be modified.
+
+        Notes
+        -----
+        The ranges are intersected directly with a sweep over every person's stored ranges, so the cost of
+        this operation depends on the number of stored ranges and not on the number of hours they cover.
+        If the database has a bitmap index, the participants' weekly bitmaps are intersected instead.
+        If the calendar has a cache, repeated queries are answered from it until one of the participants
+        is modified.
+        """
+        retval = self.check_meeting(interviewee, interviewers, start, end)
+        retval['data'] = SlotSet()
+        if retval['code'] == 0:
+            if self.cache is not None:
+                key = self.cache.key(interviewers+[interviewee], hour_bounds(start, end))
+                versions = self.cache.snapshot(key)
+                cached = self.cache.get(key)
+                if cached is not None:
+                    retval['data'] = cached
+                    return retval
+            if self.has_bitmap_index():
+                people = [self.bitmap_weeks(person, start, end) for person in set(interviewers+[interviewee])]
+                with self.metrics.phase('intersect'):
+                    retval['data'] = intersect_bitmaps(people).clip(*hour_bounds(start, end))
+            else:
+                people = [self.slot_set(person, start, end) for person in set(interviewers+[interviewee])]
+                with self.metrics.phase('intersect'):
+                    retval['data'] = people[0].intersection(*people[1:])
+            if self.cache is not None:
+                self.cache.put(key, versions, retval['data'])
+        return retval
+
+    def organize_meeting(self, interviewee, interviewers, start=None, end=None, fmt='hours', limit=None,
+                         min_hours=1):
         """Organizes a meeting based on the stored available times.
 
         Parameters
@@ -179,6 +944,16 @@ class Calendar:
             ID of the user that must be in the meeting.
         interviewers : list(str)
             List of IDs for everyone else who should be in the meeting.
+        start : datetime, optional
+            If given, only hours that start at or after this date are considered.
+        end : datetime, optional
+            If given, only hours that start before this date are considered.
+        fmt : str, optional
+            The format of the returned slots, either 'hours' (the default) or 'ranges'.
+        limit : int, optional
+            If given, at most this many slots are returned: the earliest ones.
+        min_hours : int, optional
+            The duration of the meeting, in hours. By default, meetings last one hour.
 
         Returns
         -------
@@ -186,35 +961,339 @@ class Calendar:
             A dictionary containing a triple of fields: `code`, `desc`, and `data`.
             `code` is the return value for the operation (0 = success), `desc` is a human-readable explanation
             of the return value, and `data` is a set of returned time slots for the selected users.
+            With the 'hours' format, the slots are the hours at which a meeting of `min_hours` hours can start.
+            With the 'ranges' format, the slots are the sorted, disjoint [from, to) pairs in which everyone is
+            available for at least `min_hours` consecutive hours.
+
+        Notes
+        -----
+        When a limit is given, the participants' slots are read in order and the search stops as soon as
+        enough slots are found, so the cost depends on how far away the first meetings are rather than on the
+        size of the calendars. Those searches do not use the meeting cache.
         """
-        retval = {'code': 0, 'desc': 'Operation successful', 'data': []}
+        retval = self.check_meeting_options(fmt, limit, min_hours)
+        if retval['code'] != 0:
+            retval['data'] = []
+            return retval
+        if limit is None:
+            retval = self.meeting_slots(interviewee, interviewers, start, end)
+            ranges = retval['data']
+        else:
+            retval = self.check_meeting(interviewee, interviewers, start, end)
+            ranges = self.iter_meeting_ranges(interviewee, interviewers, start, end, min_hours) \
+                if retval['code'] == 0 else iter(())
+        # Limited searches read the slots while they are formatted, so their SQL is measured as 'expand'
+        with self.metrics.phase('expand'):
+            retval['data'] = list(self.format_slots(ranges, fmt, limit, min_hours))
+        self.metrics.count('slots', len(retval['data']))
+        return retval
 
-        if not isinstance(interviewers, list):
-            retval['code'] = 1
-            retval['desc'] = 'Wrong list of interviewers'
-        elif not isinstance(interviewee, str):
-            retval['code'] = 2
-            retval['desc'] = 'Wrong interviewee name'
-        elif len(interviewers) == 0:
-            retval['code'] = 3
-            retval['desc'] = 'Missing at least one interviewer'
+    def check_meeting_query(self, interviewee, interviewers, start=None, end=None, fmt='hours', limit=None,
+                            min_hours=1):
+        """Validates all the parameters of `organize_meeting`.
+
+        Returns
+        -------
+        dict
+            A dictionary containing a pair of fields, `code` and `desc`, with the error codes described in
+            `organize_meeting`.
+        """
+        retval = self.check_meeting_options(fmt, limit, min_hours)
+        if retval['code'] == 0:
+            retval = self.check_meeting(interviewee, interviewers, start, end)
+        return retval
+
+    def iter_meeting(self, interviewee, interviewers, start=None, end=None, fmt='hours', limit=None, min_hours=1):
+        """Iterates over the possible times of a meeting, in the same format as `organize_meeting`.
+
+        The participants' slots are read from the database as the times are consumed, and the meeting cache
+        is not used. The parameters are assumed to be valid (see `check_meeting_query`).
+        """
+        return self.format_slots(self.iter_meeting_ranges(interviewee, interviewers, start, end, min_hours),
+                                 fmt, limit, min_hours)
+
+    def check_meeting_options(self, fmt, limit, min_hours):
+        """Validates the output options of a meeting.
+
+        Returns
+        -------
+        dict
+            A dictionary containing a pair of fields, `code` and `desc`, with the error codes described in
+            `organize_meeting`.
+        """
+        retval = {'code': 0, 'desc': 'Operation successful'}
+        if fmt not in self.FORMATS:
+            retval['code'] = 5
+            retval['desc'] = 'Unknown format'
+        elif limit is not None and (not isinstance(limit, int) or isinstance(limit, bool) or limit <= 0):
+            retval['code'] = 6
+            retval['desc'] = 'Wrong limit'
+        elif not isinstance(min_hours, int) or isinstance(min_hours, bool) or min_hours <= 0:
+            retval['code'] = 7
+            retval['desc'] = 'Wrong meeting duration'
+        return retval
+
+    @staticmethod
+    def format_slots(ranges, fmt, limit=None, min_hours=1):
+        """Lazily formats sorted ranges of hours as the slots returned by `get_slots` and `organize_meeting`.
+
+        With the 'hours' format, the slots are the hours at which `min_hours` consecutive hours start. With the
+        'ranges' format, they are the ranges that last at least `min_hours`. At most `limit` slots are returned.
+        """
+        if fmt == 'ranges':
+            ranges = ((range_from, range_to) for range_from, range_to in ranges if range_to - range_from >= min_hours)
+            return ([format_hour(range_from), format_hour(range_to)]
+                    for range_from, range_to in itertools.islice(ranges, limit))
         else:
-            aggr_times = dict()
-
-            # Obtain everybody's available slots, and see whether a meeting is possible
-            for person in interviewers+[interviewee]:
-                slots = self.get_slots(person)
-                for slot in slots['data']:
-                    if slot not in aggr_times:
-                        aggr_times[slot] = []
-                    aggr_times[slot].append(person)
-            for slot in aggr_times:
-                if len(aggr_times[slot]) == 1+len(interviewers):
-                    retval['data'].append(slot)
-            # The data is returned sorted because there's no downside to it
-            retval['data'].sort()
+            starts = (hour for range_from, range_to in ranges for hour in range(range_from, range_to - min_hours + 1))
+            return map(format_hour, itertools.islice(starts, limit))
+
+    def organize_meetings(self, meetings, start=None, end=None, fmt='hours', limit=None, min_hours=1, executor=None,
+                          tasks=None):
+        """Organizes many meetings at once.
+
+        Parameters
+        ----------
+        meetings : list of (str, list(str))
+            Pairs of (interviewee, interviewers), with the same meaning as in `organize_meeting`.
+        start, end, fmt, limit, min_hours
+            Options applied to every meeting, with the same meaning as in `organize_meeting`.
+        executor : concurrent.futures.Executor, optional
+            If given, independent meetings are calculated in parallel on this executor, which is typically
+            a `ProcessPoolExecutor`. Otherwise, everything is calculated in this thread.
+        tasks : int, optional
+            The number of tasks in which the meetings are split when an executor is given. By default, one
+            per CPU.
+
+        Returns
+        -------
+        dict
+            A dictionary containing a triple of fields: `code`, `desc`, and `data`. `code` is the return value for
+            the whole batch (0 = success), `desc` is a human-readable explanation of the return value, and `data` is
+            a list with one dictionary per meeting, in the same order as `meetings`. Each of those dictionaries is
+            what `organize_meeting` would return for that meeting. If some meetings are not valid, `code` is 9, and
+            the rest of the meetings are still organized.
+
+        Notes
+        -----
+        The slots of every person are read once, no matter how many meetings they are in. Interviewers are
+        sorted before the interviewee in every meeting, so that meetings with the same interviewers (or with
+        the same first interviewers) share the intersection of those interviewers' slots.
+        """
+        retval = self.check_meeting_options(fmt, limit, min_hours)
+        if retval['code'] != 0:
+            retval['data'] = []
+            return retval
+        retval, panels = self.check_meetings(meetings, start, end)
+        results = self.panel_slots(panels, start, end, executor, tasks)
+        with self.metrics.phase('expand'):
+            for panel, result in zip(panels, retval['data']):
+                if panel is not None:
+                    result['data'] = list(self.format_slots(results[panel], fmt, limit, min_hours))
+                    self.metrics.count('slots', len(result['data']))
         return retval
 
+    def check_meetings(self, meetings, start, end):
+        """Validates a list of meetings, as given to `organize_meetings`.
+
+        Returns
+        -------
+        tuple(dict, list)
+            The return value of the batch, with one result per meeting in its `data` field, and the panel of every
+            meeting. A panel is the tuple of its sorted interviewers followed by the interviewee, or None if the
+            meeting is not valid.
+        """
+        retval = {'code': 0, 'desc': 'Operation successful', 'data': []}
+        if not isinstance(meetings, list) or not self.check_window(start, end):
+            retval['code'] = 8
+            retval['desc'] = 'Wrong list of meetings'
+            return retval, []
+
+        panels = []
+        for meeting in meetings:
+            if isinstance(meeting, (list, tuple)) and len(meeting) == 2:
+                result = self.check_meeting(meeting[0], meeting[1], start, end)
+            else:
+                result = {'code': 1, 'desc': 'Wrong meeting'}
+            result['data'] = []
+            if result['code'] == 0:
+                interviewee, interviewers = meeting
+                panel = sorted(set(interviewers) - {interviewee}) + [interviewee]
+                panels.append(tuple(panel))
+            else:
+                panels.append(None)
+                retval['code'] = 9
+                retval['desc'] = 'Some meetings are not valid'
+            retval['data'].append(result)
+        return retval, panels
+
+    def panel_slots(self, panels, start, end, executor=None, tasks=None):
+        """Calculates the hours in which everyone in each of the given panels is available.
+
+        See `organize_meetings` for the meaning of the parameters. Panels that are None are ignored.
+
+        Returns
+        -------
+        dict
+            A `SlotSet` per distinct panel.
+        """
+        # Every distinct panel is calculated once, with the slots of every distinct person
+        unique_panels = sorted(set(panel for panel in panels if panel is not None))
+        slot_sets = {person: self.slot_set(person, start, end)
+                     for person in set(itertools.chain.from_iterable(unique_panels))}
+        with self.metrics.phase('intersect'):
+            if executor is None:
+                common = intersect_panels(unique_panels, slot_sets)
+            else:
+                # Contiguous chunks of the sorted panels keep panels with the same first interviewers together
+                size = max(1, -(-len(unique_panels) // (tasks or os.cpu_count() or 1)))
+                chunks = [unique_panels[i:i+size] for i in range(0, len(unique_panels), size)]
+                futures = [executor.submit(intersect_panels, chunk,
+                                           {person: slot_sets[person] for person in set(itertools.chain(*chunk))})
+                           for chunk in chunks]
+                common = list(itertools.chain.from_iterable(future.result() for future in futures))
+        return dict(zip(unique_panels, common))
+
+    def schedule_meetings(self, meetings, start=None, end=None, duration=1, executor=None, tasks=None):
+        """Assigns a concrete time to every meeting in a batch, so that nobody is in two meetings at once.
+
+        Parameters
+        ----------
+        meetings : list of (str, list(str))
+            Pairs of (interviewee, interviewers), with the same meaning as in `organize_meeting`.
+        start : datetime, optional
+            If given, meetings only start at or after this date.
+        end : datetime, optional
+            If given, meetings only start before this date.
+        duration : int, optional
+            The length of every meeting, in hours.
+        executor, tasks
+            Used to calculate the available hours of every meeting, as in `organize_meetings`.
+
+        Returns
+        -------
+        dict
+            A dictionary containing a triple of fields: `code`, `desc`, and `data`. `code` is the return value for
+            the whole batch (0 = success), and `data` is a list with one dictionary per meeting, in the same order
+            as `meetings`. Each of those dictionaries has the fields `code`, `desc`, and `data`, which is the
+            `[from, to]` range of the meeting, or an empty list if it could not be scheduled (code 10). Invalid
+            meetings are reported as in `organize_meetings`, and the rest of the meetings are still scheduled.
+
+        Notes
+        -----
+        The assignment is a heuristic (see `scheduler.MeetingScheduler`), so it does not always place the largest
+        possible number of meetings. Only the slots of the participants are taken into account: meetings that
+        were scheduled by previous calls are not stored, and do not block any hour.
+        """
+        retval = self.check_meeting_options('hours', None, duration)
+        if retval['code'] != 0:
+            retval['data'] = []
+            return retval
+        retval, panels = self.check_meetings(meetings, start, end)
+        results = self.panel_slots(panels, start, end, executor, tasks)
+        valid = [index for index, panel in enumerate(panels) if panel is not None]
+        with self.metrics.phase('schedule'):
+            assignment = assign_meetings([panels[index] for index in valid],
+                                         [results[panels[index]] for index in valid], duration)
+        for index, hour in zip(valid, assignment):
+            result = retval['data'][index]
+            if hour is None:
+                result['code'] = 10
+                result['desc'] = 'No free time left for this meeting'
+            else:
+                result['data'] = [format_hour(hour), format_hour(hour + duration)]
+        return retval
+
+
+class CalendarPool:
+    """Keeps a bounded number of long-lived `Calendar` instances, and lends them to one thread at a time.
+
+    Opening a connection (and, in snapshot mode, copying the database into memory) is much slower than
+    a typical request, so calendars are reused across requests instead of being opened for each one.
+    They are not tied to a thread, which matters for servers that start a new thread for every request.
+    A calendar is created when one is needed and none is idle, until the pool has `size` of them; from
+    then on, `acquire` waits until another thread releases one. The schema is set up once, when the pool
+    is created.
+
+    Notes
+    -----
+    Processes never share a pool: a server with several worker processes has one pool per worker.
+
+    With a snapshot log, every calendar of the pool reads from its own in-memory copy of the database,
+    so memory use grows with the size of the pool.
+    """
+    def __init__(self, database, pragmas=None, cache=None, snapshot=None, size=8):
+        """Initializes the pool.
+
+        Parameters
+        ----------
+        database : str
+            A filename with the database connection string.
+        pragmas : dict, optional
+            SQLite pragmas to set on every connection. See `Calendar.__init__`.
+        cache : MeetingCache, optional
+            A meeting cache shared by all the calendars of the pool.
+        snapshot : SnapshotLog, optional
+            If given, reads are served from in-memory snapshots of the database, which catch up with the
+            writes recorded in this log. See `Calendar.sync_snapshot`.
+        size : int, optional
+            The maximum number of calendars (and therefore of connections) kept by the pool.
+        """
+        self.database = database
+        self.pragmas = pragmas
+        self.cache = cache
+        self.snapshot = snapshot
+        self.size = size
+        self.lock = threading.Lock()
+        # The most recently released calendar is lent first, so idle ones stay idle
+        self.idle = queue.LifoQueue()
+        # The first connection creates and upgrades the schema
+        self.idle.put(self.create(init_schema=True))
+        self.created = 1
+
+    def create(self, init_schema=False):
+        return Calendar(self.database, self.pragmas, init_schema=init_schema, cache=self.cache,
+                        snapshot=self.snapshot, check_same_thread=False)
+
+    def acquire(self):
+        """Takes a calendar from the pool. It must be given back with `release` once the caller is done with it."""
+        with self.lock:
+            create = self.idle.empty() and self.created < self.size
+            if create:
+                self.created += 1
+        if not create:
+            return self.idle.get()
+        try:
+            return self.create()
+        except Exception:
+            with self.lock:
+                self.created -= 1
+            raise
+
+    def release(self, calendar):
+        """Gives back a calendar taken with `acquire`."""
+        self.idle.put(calendar)
+
+    @contextlib.contextmanager
+    def calendar(self):
+        """Context manager that lends a calendar for the duration of a block."""
+        calendar = self.acquire()
+        try:
+            yield calendar
+        finally:
+            self.release(calendar)
+
+    def close(self):
+        """Closes the calendars that are idle. Calendars that are still lent are not affected."""
+        while True:
+            try:
+                calendar = self.idle.get_nowait()
+            except queue.Empty:
+                return
+            with self.lock:
+                self.created -= 1
+            calendar.close()
+
 
 class TestCaseAdd(unittest.TestCase):
     """Tests adding items to the calendar.
@@ -270,7 +1349,8 @@ class TestCaseAdd(unittest.TestCase):
         self.assertEqual(retval['code'], 0, 'The \'add_slots\' operation should succeed')
         retval = self.testCal.get_slots('existing_username')
         slots_after = len(retval['data'])
-        self.assertEqual(slots_after - slots_before, 13, 'The \'add_slots\' operation is not adding correctly')
+        # The existing 13:00 slot is merged into the new range, so it is not listed twice
+        self.assertEqual(slots_after - slots_before, 12, 'The \'add_slots\' operation is not adding correctly')
 
         # Tests whether it's possible to add a slot for a user that doesn't exist
         retval = self.testCal.get_slots('random_username')
@@ -280,6 +1360,62 @@ class TestCaseAdd(unittest.TestCase):
         retval = self.testCal.add_slots('random_username', start, end)
         self.assertNotEqual(retval['code'], 0, 'Adding slots to a non-existent user should not succeed')
 
+    def count_rows(self):
+        """Returns the number of rows in the slots table, to check that merged slots are stored as one row."""
+        return self.testCal.conn.execute(self.testCal.COUNT_SLOTS_SQL).fetchone()[0]
+
+    def testCoalesce(self):
+        """Tests whether overlapping and adjacent slots are merged when they are added."""
+        user = 'existing_username'
+        self.testCal.add_slots(user, datetime(2018, 12, 15, 8, 40), datetime(2018, 12, 15, 10, 59))
+        self.testCal.add_slots(user, datetime(2018, 12, 15, 12), datetime(2018, 12, 15, 14))
+        self.assertEqual(self.count_rows(), 2, 'Disjoint slots should be kept apart')
+        self.assertEqual(self.testCal.get_slots(user)['data'][0], '2018-12-15T08:00:00', 'Minutes were not removed')
+        self.testCal.add_slots(user, datetime(2018, 12, 15, 10), datetime(2018, 12, 15, 12))
+        self.assertEqual(self.count_rows(), 1, 'Adjacent slots were not merged')
+        self.assertEqual(self.testCal.get_slots(user, fmt='ranges')['data'],
+                         [['2018-12-15T08:00:00', '2018-12-15T14:00:00']])
+        retval = self.testCal.add_slots(user, datetime(2018, 12, 15, 16, 10), datetime(2018, 12, 15, 16, 50))
+        self.assertEqual(retval['code'], 2, 'Slots shorter than an hour should be rejected')
+
+        retval = self.testCal.add_slots_bulk([(user, datetime(2018, 12, 16, 8), datetime(2018, 12, 16, 10)),
+                                              (user, datetime(2018, 12, 16, 9), datetime(2018, 12, 16, 12)),
+                                              (user, datetime(2018, 12, 15, 13), datetime(2018, 12, 15, 18))])
+        self.assertEqual(retval['added'], 3, 'The bulk slots should be added')
+        self.assertEqual(self.count_rows(), 2, 'Bulk slots were not merged')
+        self.assertEqual(len(self.testCal.get_slots(user)['data']), 10 + 4)
+
+        # Databases written by older versions can have overlapping slots, which `compact` merges
+        self.testCal.conn.executemany(self.testCal.ADD_SLOT_SQL,
+                                      [self.testCal.slot_row(user, 420000, 420005),
+                                       self.testCal.slot_row(user, 420003, 420008)])
+        self.testCal.conn.commit()
+        before = self.testCal.get_slots(user, fmt='ranges')['data']
+        retval = self.testCal.compact()
+        self.assertEqual((retval['code'], retval['before'], retval['after']), (0, 4, 3))
+        self.assertEqual(self.testCal.get_slots(user, fmt='ranges')['data'], before, 'Compacting changed the slots')
+
+    def testAddBulk(self):
+        """Tests whether adding many elements at once works, and reports the rows that cannot be added."""
+        retval = self.testCal.add_users_bulk([('manager1', 'Manager 1'), ('existing_username', 'Again'),
+                                              ('manager2', 'Manager 2'), ('manager1', 'Twice'), 'manager3'])
+        self.assertEqual(retval['code'], 1, 'Rejected users should be reported')
+        self.assertEqual(retval['added'], 2, 'The valid users should be added')
+        self.assertEqual([error['index'] for error in retval['errors']], [1, 3, 4], 'The wrong users were rejected')
+        self.assertEqual(self.testCal.get_user('manager2')['data'], 'Manager 2', 'The users were not added')
+        self.testCal.add_users_bulk([("o'brien", "O'Brien")])
+        self.assertEqual(self.testCal.get_user("o'brien")['data'], "O'Brien", 'Quotes in usernames should be escaped')
+
+        retval = self.testCal.add_slots_bulk([('manager1', datetime(2018, 12, 15, 8), datetime(2018, 12, 15, 12)),
+                                              ('random_username', datetime(2018, 12, 15, 8), datetime(2018, 12, 15, 9)),
+                                              ('manager1', datetime(2018, 12, 15, 14), datetime(2018, 12, 15, 14)),
+                                              ('manager2', datetime(2018, 12, 15, 9), datetime(2018, 12, 15, 10)),
+                                              ('manager2', '2018-12-15T10:00:00', datetime(2018, 12, 15, 11))])
+        self.assertEqual([(error['index'], error['code']) for error in retval['errors']], [(1, 3), (2, 2), (4, 1)],
+                         'The wrong slots were rejected')
+        self.assertEqual(len(self.testCal.get_slots('manager1')['data']), 4, 'The slots were not added')
+        self.assertEqual(len(self.testCal.get_slots('manager2')['data']), 1, 'The slots were not added')
+
 
 class TestCaseGet(unittest.TestCase):
     """Tests querying items from the calendar.
@@ -329,6 +1465,12 @@ class TestCaseGet(unittest.TestCase):
         self.assertNotEqual(retval['code'], 0, 'You should require at least one interviewer')
         retval = self.testCal.organize_meeting('interviewee', 'manager1')
         self.assertNotEqual(retval['code'], 0, 'The interviewer cannot be a string. It should be a list.')
+        retval = self.testCal.organize_meeting('interviewee', ['manager1', ['manager2']])
+        self.assertEqual(retval['code'], 1, 'Every interviewer should be a string')
+        retval = self.testCal.organize_meetings([('interviewee', [1, ['x']]), (['interviewee'], ['manager1']),
+                                                 ('interviewee', ['manager1'])])
+        self.assertEqual([result['code'] for result in retval['data']], [1, 2, 0],
+                         'Meetings with wrong participants should be rejected one by one')
 
     def testMeeting(self):
         retval = self.testCal.organize_meeting('interviewee', ['manager1'])
@@ -346,11 +1488,411 @@ class TestCaseGet(unittest.TestCase):
         retval = self.testCal.organize_meeting('interviewee', ['manager1', 'manager2', 'manager3'])
         self.assertEqual(len(retval['data']), 1, 'The number of available slots for meeting 6 is incorrect')
 
+    def testWindow(self):
+        # Tuesday morning only
+        start = datetime(2018, 11, 20, 0)
+        end = datetime(2018, 11, 20, 12)
+        retval = self.testCal.get_slots('manager1', start, end)
+        self.assertEqual(retval['code'], 0, 'Asking for slots inside a window should succeed')
+        self.assertEqual(retval['data'], [slot for slot in self.testCal.get_slots('manager1')['data']
+                                          if start.isoformat() <= slot < end.isoformat()],
+                         'The slots inside a window are incorrect')
+        retval = self.testCal.organize_meeting('interviewee', ['manager1'], start=start, end=end)
+        self.assertEqual(retval['data'], [slot for slot in self.testCal.organize_meeting('interviewee', ['manager1'])['data']
+                                          if start.isoformat() <= slot < end.isoformat()],
+                         'The meeting slots inside a window are incorrect')
+        retval = self.testCal.get_slots('manager1', end, start)
+        self.assertNotEqual(retval['code'], 0, 'Windows that end before they start should be rejected')
+        retval = self.testCal.organize_meeting('interviewee', ['manager1'], start='2018-11-20')
+        self.assertNotEqual(retval['code'], 0, 'Windows must be given as dates')
+
+    def testRanges(self):
+        retval = self.testCal.get_slots('manager1', fmt='ranges')
+        self.assertEqual(retval['data'], [['2018-11-19T08:00:00', '2018-11-19T18:00:00'],
+                                          ['2018-11-21T08:00:00', '2018-11-21T18:00:00'],
+                                          ['2018-11-23T08:00:00', '2018-11-23T18:00:00']],
+                         'The slots were not returned as ranges')
+        retval = self.testCal.organize_meeting('interviewee', ['manager1', 'manager2'], fmt='ranges')
+        self.assertEqual(retval['data'], [['2018-11-19T11:00:00', '2018-11-19T17:00:00'],
+                                          ['2018-11-21T11:00:00', '2018-11-21T17:00:00']],
+                         'The meeting was not returned as ranges')
+        retval = self.testCal.organize_meeting('interviewee', ['manager1'], fmt='csv')
+        self.assertNotEqual(retval['code'], 0, 'Unknown formats should be rejected')
+
+    def testStreaming(self):
+        start = datetime(2018, 11, 20)
+        for fmt in Calendar.FORMATS:
+            self.assertEqual(list(self.testCal.iter_slots('manager1', start, fmt=fmt)),
+                             self.testCal.get_slots('manager1', start, fmt=fmt)['data'],
+                             'Streamed slots disagree with the listing')
+            self.assertEqual(list(self.testCal.iter_meeting('interviewee', ['manager1', 'manager2'], fmt=fmt)),
+                             self.testCal.organize_meeting('interviewee', ['manager1', 'manager2'], fmt=fmt)['data'],
+                             'Streamed meetings disagree with the full meeting')
+        slots = self.testCal.iter_slots('manager2')
+        self.assertEqual(next(slots), '2018-11-19T11:00:00', 'Streamed slots should be available one at a time')
+        self.assertEqual(self.testCal.check_slots(None, None, 'bad')['code'], 2)
+        self.assertEqual(self.testCal.check_meeting_query('interviewee', ['manager1'], limit=0)['code'], 6)
+
+    def testMetrics(self):
+        metrics = Metrics(enabled=True)
+        cal = Calendar(self.new_db.name, metrics=metrics)
+        started = metrics.begin('test')
+        cal.get_slots('manager1')
+        cal.organize_meeting('interviewee', ['manager1'])
+        metrics.end(started)
+        cal.close()
+        text = metrics.render()
+        # manager1 has 3 rows with 30 hours, and the interviewee has 3 rows, of which 2 overlap with manager1
+        self.assertIn('calendar_items_total{endpoint="test",kind="rows"} 9', text)
+        self.assertIn('calendar_items_total{endpoint="test",kind="slots"} ' + str(30 + 16), text)
+        for phase in ('sql', 'expand', 'intersect'):
+            self.assertIn('calendar_phase_seconds_count{{endpoint="test",phase="{}"}}'.format(phase), text)
+        self.assertIn('calendar_phase_seconds_count{endpoint="none",phase="connect"} 1', text)
+
+    def testMeetingLimit(self):
+        full = self.testCal.organize_meeting('interviewee', ['manager2'])['data']
+        retval = self.testCal.organize_meeting('interviewee', ['manager2'], limit=3)
+        self.assertEqual(retval['data'], full[:3], 'A limited meeting should return the earliest slots')
+        # manager2 and the interviewee share 6 hours on each of the three days the interviewee is available
+        retval = self.testCal.organize_meeting('interviewee', ['manager2'], min_hours=6)
+        self.assertEqual(retval['data'], ['2018-11-19T11:00:00', '2018-11-20T11:00:00', '2018-11-21T11:00:00'],
+                         'A meeting of several hours should only start where all of them are available')
+        retval = self.testCal.organize_meeting('interviewee', ['manager2'], fmt='ranges', limit=2, min_hours=5)
+        self.assertEqual(retval['data'], [['2018-11-19T11:00:00', '2018-11-19T17:00:00'],
+                                          ['2018-11-20T11:00:00', '2018-11-20T17:00:00']],
+                         'A limited meeting should return the earliest ranges')
+        retval = self.testCal.organize_meeting('interviewee', ['manager2'], limit=0)
+        self.assertNotEqual(retval['code'], 0, 'The limit must be positive')
+        retval = self.testCal.organize_meeting('interviewee', [], limit=1)
+        self.assertNotEqual(retval['code'], 0, 'Limited meetings should also be validated')
+        retval = self.testCal.organize_meeting('interviewee', ['manager2'], limit=2.5)
+        self.assertEqual(retval['code'], 6, 'The limit must be an integer')
+        retval = self.testCal.organize_meeting('interviewee', ['manager2'], min_hours=True)
+        self.assertEqual(retval['code'], 7, 'Booleans are not meeting durations')
+
+    def testMeetingCache(self):
+        cachedCal = Calendar(self.new_db.name, cache=MeetingCache())
+        first = cachedCal.organize_meeting('interviewee', ['manager1', 'manager2'])
+        second = cachedCal.organize_meeting('interviewee', ['manager2', 'manager1'])
+        self.assertEqual(first, second, 'A cached meeting should not change')
+        self.assertEqual(cachedCal.cache.stats()['hits'], 1, 'The order of the interviewers should not matter')
+        # Adding a slot to any participant must invalidate the cached result
+        cachedCal.add_slots('manager2', datetime(2018, 11, 19, 10), datetime(2018, 11, 19, 11))
+        third = cachedCal.organize_meeting('interviewee', ['manager1', 'manager2'])
+        self.assertEqual(len(third['data']), len(first['data'])+1, 'The cache returned a stale meeting')
+
+    def testMeetingEngine(self):
+        # The interval engine must return exactly the same hours as counting every expanded hour
+        users = ['manager1', 'manager2', 'manager3']
+        for size in range(1, len(users)+1):
+            for interviewers in itertools.combinations(users, size):
+                retval = self.testCal.organize_meeting('interviewee', list(interviewers))
+                self.assertEqual(retval['data'], count_meeting_hours(self.testCal, ['interviewee']+list(interviewers)),
+                                 'The meeting engine disagrees with the hour count for {}'.format(interviewers))
+
+
+class TestCaseMeetingEngine(unittest.TestCase):
+    """Compares the interval meeting engine against the hour count on larger, randomized calendars."""
+    def setUp(self):
+        self.new_db = tempfile.NamedTemporaryFile(delete=False)
+        self.testCal = Calendar(self.new_db.name)
+        self.users = ['user{}'.format(i) for i in range(8)]
+        rng = random.Random(42)
+        base = datetime(2018, 11, 19)
+        for user in self.users:
+            self.testCal.add_user(user, user)
+            # Ranges of the same user do not overlap, because the hour count would count them twice
+            ranges = []
+            hour = rng.randint(0, 48)
+            for _ in range(rng.randint(20, 60)):
+                length = rng.randint(1, 10)
+                ranges.append((base + timedelta(hours=hour), base + timedelta(hours=hour+length)))
+                hour += length + rng.randint(0, 12)
+            rng.shuffle(ranges)
+            for date_from, date_to in ranges:
+                self.testCal.add_slots(user, date_from, date_to)
+
+    def tearDown(self):
+        os.unlink(self.new_db.name)
+
+    def testRandomMeetings(self):
+        rng = random.Random(7)
+        for _ in range(30):
+            people = rng.sample(self.users, rng.randint(2, len(self.users)))
+            retval = self.testCal.organize_meeting(people[0], people[1:])
+            self.assertEqual(retval['code'], 0, 'Organizing a meeting should succeed')
+            self.assertEqual(retval['data'], count_meeting_hours(self.testCal, people),
+                             'The meeting engine disagrees with the hour count for {}'.format(people))
+            limited = self.testCal.organize_meeting(people[0], people[1:], limit=5)
+            self.assertEqual(limited['data'], retval['data'][:5], 'The limited search disagrees with the full one')
+
+    def testBatchMeetings(self):
+        rng = random.Random(3)
+        interviewers = self.users[:4]
+        meetings = [(rng.choice(self.users[4:]), rng.sample(interviewers, rng.randint(1, 3))) for _ in range(20)]
+        meetings.append(('user4', []))
+        expected = [self.testCal.organize_meeting(interviewee, panel, fmt='ranges') for interviewee, panel in meetings]
+        retval = self.testCal.organize_meetings(meetings, fmt='ranges')
+        self.assertEqual(retval['code'], 9, 'Invalid meetings should be reported')
+        self.assertEqual(retval['data'], expected, 'The batch disagrees with the individual meetings')
+        with concurrent.futures.ProcessPoolExecutor(max_workers=2) as executor:
+            retval = self.testCal.organize_meetings(meetings, fmt='ranges', executor=executor, tasks=3)
+        self.assertEqual(retval['data'], expected, 'The parallel batch disagrees with the individual meetings')
+
+    def testScheduleMeetings(self):
+        rng = random.Random(5)
+        meetings = [(rng.choice(self.users[4:]), rng.sample(self.users[:4], rng.randint(1, 2))) for _ in range(40)]
+        retval = self.testCal.schedule_meetings(meetings, duration=2)
+        self.assertEqual(retval['code'], 0, 'Scheduling the meetings should succeed')
+        schedules = dict()
+        for (interviewee, interviewers), result in zip(meetings, retval['data']):
+            if result['code'] == 10:
+                continue
+            self.assertEqual(result['code'], 0)
+            options = self.testCal.organize_meeting(interviewee, interviewers, min_hours=2)['data']
+            self.assertIn(result['data'][0], options, 'A meeting was scheduled when someone is not available')
+            for person in interviewers + [interviewee]:
+                schedules.setdefault(person, []).append(result['data'])
+        self.assertGreater(len(schedules), 0, 'No meeting was scheduled')
+        for person, schedule in schedules.items():
+            # ISO dates sort chronologically, so consecutive meetings must not overlap once sorted
+            schedule.sort()
+            for previous, current in zip(schedule, schedule[1:]):
+                self.assertLessEqual(previous[1], current[0], '{} has two meetings at once'.format(person))
+
+    def testBitmapIndex(self):
+        self.assertEqual(self.testCal.build_bitmap_index()['code'], 0, 'Building the bitmap index should succeed')
+        self.assertTrue(self.testCal.has_bitmap_index(), 'The bitmap index was not created')
+        # The index must be kept up to date by both kinds of writes
+        self.testCal.add_slots('user0', datetime(2018, 11, 20, 3), datetime(2018, 12, 3, 5))
+        self.testCal.add_slots_bulk([('user1', datetime(2018, 11, 25), datetime(2018, 12, 2)),
+                                     ('user2', datetime(2018, 11, 19), datetime(2018, 11, 30))])
+        rng = random.Random(11)
+        window = (datetime(2018, 11, 21, 5, 30), datetime(2018, 12, 10))
+        for _ in range(30):
+            people = rng.sample(self.users, rng.randint(2, len(self.users)))
+            for start, end in ((None, None), window):
+                # The new slots overlap with existing ones, so the sweep is used as reference instead of the hour count
+                slot_sets = [self.testCal.slot_set(person, start, end) for person in people]
+                retval = self.testCal.organize_meeting(people[0], people[1:], start, end)
+                self.assertEqual(retval['data'], slot_sets[0].intersection(*slot_sets[1:]).to_hours(),
+                                 'The bitmap index disagrees with the sweep for {}'.format(people))
+
+
+class TestCaseSchema(unittest.TestCase):
+    """Tests that databases created with an older schema are upgraded when opened."""
+    def setUp(self):
+        # Create a database with the original schema, where dates are only stored as text
+        self.new_db = tempfile.NamedTemporaryFile(delete=False)
+        conn = sqlite3.connect(self.new_db.name)
+        conn.execute(Calendar.INIT_DB_SQL1)
+        conn.execute(Calendar.INIT_DB_SQL2)
+        conn.execute("INSERT INTO people VALUES ('manager1', 'Manager 1');")
+        conn.execute("INSERT INTO slots VALUES ('manager1', '2018-11-19T08:00:00', '2018-11-19T12:00:00');")
+        conn.execute("INSERT INTO slots VALUES ('manager1', '2018-11-20T14:00:00', '2018-11-20T16:00:00');")
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        os.unlink(self.new_db.name)
+
+    def testUpgrade(self):
+        testCal = Calendar(self.new_db.name)
+        version = testCal.conn.execute("PRAGMA user_version").fetchone()[0]
+        self.assertEqual(version, len(Calendar.MIGRATIONS), 'The database was not upgraded to the latest version')
+        retval = testCal.get_slots('manager1')
+        self.assertEqual(len(retval['data']), 6, 'Slots stored before the upgrade are not readable')
+        self.assertEqual(retval['data'][0], '2018-11-19T08:00:00', 'Slots stored before the upgrade are wrong')
+        # Opening the database again must not run the migrations a second time
+        testCal = Calendar(self.new_db.name)
+        self.assertEqual(len(testCal.get_slots('manager1')['data']), 6, 'Reopening the database changed its slots')
+
+    def testConcurrentUpgrade(self):
+        # Another process holds the write lock while it upgrades the database
+        conn = sqlite3.connect(self.new_db.name, isolation_level=None)
+        conn.execute("BEGIN IMMEDIATE")
+        results = []
+        thread = threading.Thread(target=lambda: results.append(Calendar(self.new_db.name, check_same_thread=False)))
+        thread.start()
+        thread.join(0.2)
+        for migration in Calendar.MIGRATIONS:
+            for statement in migration:
+                conn.execute(statement)
+        conn.execute("PRAGMA user_version = {:d}".format(len(Calendar.MIGRATIONS)))
+        conn.execute("COMMIT")
+        conn.close()
+        thread.join()
+        self.assertEqual(len(results), 1, 'A database upgraded by another process should not be upgraded again')
+        self.assertEqual(len(results[0].get_slots('manager1')['data']), 6)
+
+    def testCoveringIndex(self):
+        testCal = Calendar(self.new_db.name)
+        plan = ' '.join(row['detail'] for row in
+                        testCal.conn.execute("EXPLAIN QUERY PLAN " + Calendar.GET_SLOT_SQL, ('manager1',)))
+        self.assertIn('COVERING INDEX slots_by_user', plan, 'Slot queries should not read the table itself')
+
+
+class TestCasePool(unittest.TestCase):
+    """Tests that a pool reuses a bounded number of calendars across threads."""
+    def setUp(self):
+        self.new_db = tempfile.NamedTemporaryFile(delete=False)
+        self.pool = CalendarPool(self.new_db.name, {'journal_mode': 'wal', 'synchronous': 'normal'}, size=2)
+
+    def tearDown(self):
+        self.pool.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.new_db.name + suffix):
+                os.unlink(self.new_db.name + suffix)
+
+    def testReuse(self):
+        with self.pool.calendar() as cal:
+            journal_mode = cal.conn.execute("PRAGMA journal_mode").fetchone()[0]
+            self.assertEqual(journal_mode, 'wal', 'The pragmas of the pool were not applied')
+            cal.add_user('manager1', 'Manager 1')
+        results = []
+
+        def worker():
+            with self.pool.calendar() as other:
+                results.append((other, other.get_user('manager1')['data']))
+        # Servers that start a thread per request should still reuse the same connections
+        for _ in range(3):
+            thread = threading.Thread(target=worker)
+            thread.start()
+            thread.join()
+        self.assertTrue(all(other is cal for other, _ in results), 'Idle calendars should be reused by other threads')
+        self.assertEqual(results[0][1], 'Manager 1', 'Calendars should see the same database')
+
+    def testBounded(self):
+        first, second = self.pool.acquire(), self.pool.acquire()
+        self.assertIsNot(first, second, 'A calendar should not be lent twice')
+        results = []
+        thread = threading.Thread(target=lambda: results.append(self.pool.acquire()))
+        thread.start()
+        thread.join(0.1)
+        self.assertEqual(results, [], 'A full pool should wait for a calendar to be released')
+        self.pool.release(second)
+        thread.join()
+        self.assertEqual(results, [second])
+        self.pool.release(first)
+        self.pool.release(second)
+        self.assertEqual(self.pool.created, 2)
+
+
+class TestCaseSnapshot(unittest.TestCase):
+    """Tests that in-memory snapshots follow the writes of the pool, and of other processes once refreshed."""
+    def setUp(self):
+        self.new_db = tempfile.NamedTemporaryFile(delete=False)
+        self.now = 0.0
+        self.log = SnapshotLog(maxsize=4, refresh=5.0, clock=lambda: self.now)
+        self.pool = CalendarPool(self.new_db.name, {'journal_mode': 'wal'}, snapshot=self.log)
+        # Two calendars of the pool, as if they were used by two threads
+        self.cal, self.other = self.pool.acquire(), self.pool.acquire()
+        self.cal.add_user('manager1', 'Manager 1')
+        self.cal.add_slots('manager1', datetime(2018, 12, 12, 14), datetime(2018, 12, 12, 18))
+
+    def tearDown(self):
+        self.pool.release(self.cal)
+        self.pool.release(self.other)
+        self.pool.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.new_db.name + suffix):
+                os.unlink(self.new_db.name + suffix)
+
+    def testReads(self):
+        cal = self.cal
+        self.assertIsNot(cal.reads, cal.conn, 'Reads should not use the database file')
+        self.assertEqual(len(cal.get_slots('manager1')['data']), 4)
+        # Writes of other calendars of the pool are applied to the snapshot
+        self.other.add_slots('manager1', datetime(2018, 12, 12, 20), datetime(2018, 12, 12, 22))
+        self.assertEqual(len(cal.get_slots('manager1')['data']), 6)
+        # Checking for changes of other processes should not reload the changes of the pool again
+        reads = cal.reads
+        self.now += 5.0
+        self.assertEqual(len(cal.get_slots('manager1')['data']), 6)
+        self.assertIs(cal.reads, reads, 'Changes of the pool should not reload the snapshot')
+        self.assertEqual(self.log.stats()['reloads'], 0)
+        # Writes of other processes are only seen after the refresh interval
+        external = Calendar(self.new_db.name)
+        external.add_user('manager2', 'Manager 2')
+        self.assertEqual(cal.get_user('manager2')['data'], '')
+        self.now += 5.0
+        self.assertEqual(cal.get_user('manager2')['data'], 'Manager 2')
+        self.assertEqual(self.log.stats()['reloads'], 1, 'Reloads should be counted')
+        self.assertRaises(sqlite3.ProgrammingError, reads.execute, "SELECT 1;")
+
+    def testOpenCursors(self):
+        cal = self.cal
+        self.other.add_user('manager2', 'Manager 2')
+        for day in range(13, 18):
+            for user_id in ('manager1', 'manager2'):
+                self.other.add_slots(user_id, datetime(2018, 12, day, 10), datetime(2018, 12, day, 11))
+        hours = cal.iter_meeting('manager1', ['manager2'])
+        self.assertEqual(next(hours), '2018-12-13T10:00:00')
+        # A change of another process forces a reload, which must wait until the meeting is read
+        Calendar(self.new_db.name).add_slots('manager2', datetime(2018, 12, 12, 14), datetime(2018, 12, 12, 15))
+        self.now += 5.0
+        self.assertEqual(cal.get_user('manager1')['data'], 'Manager 1')
+        self.assertEqual(len(list(hours)), 4, 'Open cursors should keep reading the same snapshot')
+        self.assertEqual(len(cal.organize_meeting('manager1', ['manager2'])['data']), 6)
+
+    def testMeetingCache(self):
+        self.pool.release(self.cal)
+        self.pool.release(self.other)
+        self.pool.close()
+        self.pool = CalendarPool(self.new_db.name, {'journal_mode': 'wal'}, cache=MeetingCache(), snapshot=self.log)
+        self.cal, self.other = self.pool.acquire(), self.pool.acquire()
+        self.cal.add_user('manager2', 'Manager 2')
+        self.cal.add_slots('manager2', datetime(2018, 12, 12, 14), datetime(2018, 12, 12, 16))
+        self.assertEqual(len(self.other.organize_meeting('manager1', ['manager2'])['data']), 2)
+        record = self.log.record
+
+        def record_later(user_id, change):
+            # Another calendar of the pool runs the meeting after the commit, but before the change is recorded
+            self.other.organize_meeting('manager1', ['manager2'])
+            record(user_id, change)
+        self.log.record = record_later
+        self.cal.add_slots('manager2', datetime(2018, 12, 12, 16), datetime(2018, 12, 12, 18))
+        self.log.record = record
+        self.assertEqual(len(self.other.organize_meeting('manager1', ['manager2'])['data']), 4,
+                         'A meeting read from an old snapshot was cached as up to date')
+
+    def testBitmapIndex(self):
+        cal = self.cal
+        cal.add_user('manager2', 'Manager 2')
+        cal.add_slots('manager2', datetime(2018, 12, 12, 0), datetime(2018, 12, 14, 0))
+        self.other.build_bitmap_index()
+        self.assertTrue(cal.has_bitmap_index(), 'Building the index should reload the snapshots')
+        self.other.add_slots('manager1', datetime(2018, 12, 13, 14), datetime(2018, 12, 13, 15))
+        meeting = cal.organize_meeting('manager1', ['manager2'])['data']
+        self.assertEqual(meeting, count_meeting_hours(cal, ['manager1', 'manager2']))
+        self.assertEqual(len(meeting), 5, 'The bitmaps of the snapshot were not updated')
+
+
+def count_meeting_hours(cal, people):
+    """Reference implementation of a meeting: counts every hour of the stored slots of every person in a dict.
+
+    The slots are read from the text dates of the `slots` table, so that no code of the meeting engine is used.
+    """
+    aggr_times = dict()
+    for person in people:
+        hours = set()
+        for row in cal.conn.execute("SELECT date_from, date_to FROM slots WHERE username = ?;", (person,)):
+            hour = datetime.strptime(row['date_from'], '%Y-%m-%dT%H:%M:%S')
+            while hour < datetime.strptime(row['date_to'], '%Y-%m-%dT%H:%M:%S'):
+                hours.add(hour.isoformat())
+                hour += timedelta(hours=1)
+        for hour in hours:
+            aggr_times[hour] = aggr_times.get(hour, 0) + 1
+    return sorted(slot for slot in aggr_times if aggr_times[slot] == len(people))
 
 if __name__ == '__main__':
     # Run all test cases
     suite_loader = unittest.TestLoader()
     suite1 = suite_loader.loadTestsFromTestCase(TestCaseAdd)
     suite2 = suite_loader.loadTestsFromTestCase(TestCaseGet)
-    suite = unittest.TestSuite([suite1, suite2])
+    suite3 = suite_loader.loadTestsFromTestCase(TestCaseMeetingEngine)
+    suite4 = suite_loader.loadTestsFromTestCase(TestCaseSchema)
+    suite5 = suite_loader.loadTestsFromTestCase(TestCasePool)
+    suite6 = suite_loader.loadTestsFromTestCase(TestCaseSnapshot)
+    suite = unittest.TestSuite([suite1, suite2, suite3, suite4, suite5, suite6])
     unittest.TextTestRunner(verbosity=2).run(suite)
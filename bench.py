@@ -0,0 +1,208 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from backend import Calendar
+
+# Hours covered by the generated calendars, counting from BASE_DATE
+HORIZON = 24 * 365
+BASE_DATE = datetime(2018, 1, 1)
+
+
+def generate(cal, num_users, num_ranges, range_length, seed):
+    """Fills a calendar with random users and slots.
+
+    Every user gets `num_ranges` ranges of `range_length` hours, starting at random hours of a one-year horizon.
+
+    Returns
+    -------
+    list(str)
+        The IDs of the generated users.
+    """
+    rng = random.Random(seed)
+    users = ['user{}'.format(i) for i in range(num_users)]
+    cal.add_users_bulk([(user, 'User {}'.format(i)) for i, user in enumerate(users)])
+    slots = []
+    for user in users:
+        for _ in range(num_ranges):
+            start = BASE_DATE + timedelta(hours=rng.randrange(HORIZON - range_length))
+            slots.append((user, start, start + timedelta(hours=range_length)))
+    cal.add_slots_bulk(slots)
+    return users
+
+
+def percentile(values, fraction):
+    """Returns the value below which the given fraction of the (sorted) values fall."""
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def measure(func, args_list):
+    """Runs a function once per set of arguments, and measures its latency and peak memory.
+
+    Returns
+    -------
+    dict
+        The number of calls, the throughput (calls per second), the 50th and 99th percentile of the
+        latency (in milliseconds), and the peak memory allocated during a single call (in KiB).
+    """
+    latencies = []
+    for args in args_list:
+        start = time.perf_counter()
+        func(*args)
+        latencies.append(time.perf_counter() - start)
+    # Memory is measured in a separate call, because tracing allocations distorts the timings
+    tracemalloc.start()
+    func(*args_list[0])
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    latencies.sort()
+    return {'calls': len(latencies),
+            'throughput': len(latencies) / sum(latencies),
+            'p50_ms': 1000 * percentile(latencies, 0.5),
+            'p99_ms': 1000 * percentile(latencies, 0.99),
+            'peak_kib': peak / 1024}
+
+
+def bench_backend(database, users, args, rng):
+    """Benchmarks the methods of `Calendar` directly."""
+    cal = Calendar(database)
+    panels = [rng.sample(users, args.panel) for _ in range(args.calls)]
+    windows = []
+    for _ in range(args.calls):
+        start = BASE_DATE + timedelta(hours=rng.randrange(HORIZON))
+        windows.append((start, start + timedelta(days=14)))
+    new_slots = []
+    for i in range(args.calls):
+        start = BASE_DATE + timedelta(hours=rng.randrange(HORIZON - args.length))
+        new_slots.append((rng.choice(users), start, start + timedelta(hours=args.length)))
+
+    results = dict()
+    results['get_slots'] = measure(cal.get_slots, [(rng.choice(users),) for _ in range(args.calls)])
+    results['get_slots_ranges'] = measure(lambda user: cal.get_slots(user, fmt='ranges'),
+                                          [(rng.choice(users),) for _ in range(args.calls)])
+    results['organize_meeting'] = measure(cal.organize_meeting, [(panel[0], panel[1:]) for panel in panels])
+    results['organize_meeting_ranges'] = measure(lambda panel: cal.organize_meeting(panel[0], panel[1:], fmt='ranges'),
+                                                 [(panel,) for panel in panels])
+    results['organize_meeting_window'] = measure(cal.organize_meeting,
+                                                 [(panel[0], panel[1:], start, end)
+                                                  for panel, (start, end) in zip(panels, windows)])
+    results['schedule_meetings'] = measure(cal.schedule_meetings, [([(panel[0], panel[1:]) for panel in panels],)])
+    results['add_slots'] = measure(cal.add_slots, new_slots)
+    results['add_slots_bulk'] = measure(cal.add_slots_bulk, [(new_slots,)])
+    cal.close()
+    return results
+
+
+def bench_flask(database, users, args, rng):
+    """Benchmarks the Flask resources through the test client of the application."""
+    # The server reads its configuration when it is imported. The meeting cache is disabled,
+    # since otherwise repeated panels would only measure cache hits.
+    os.environ['CALENDAR_DATABASE'] = database
+    os.environ['CALENDAR_MEETING_CACHE_SIZE'] = '0'
+    import flask_server
+    client = flask_server.app.test_client()
+
+    def get(url):
+        response = client.get(url)
+        assert response.status_code == 200, url
+
+    results = dict()
+    results['http_people'] = measure(get, [('/people/' + rng.choice(users),) for _ in range(args.calls)])
+    results['http_slots'] = measure(get, [('/slots/' + rng.choice(users),) for _ in range(args.calls)])
+    results['http_meeting'] = measure(get, [('/meeting/' + ','.join(rng.sample(users, args.panel)),)
+                                            for _ in range(args.calls)])
+    results['http_meeting_ranges'] = measure(get, [('/meeting/' + ','.join(rng.sample(users, args.panel)) +
+                                                    '?format=ranges',)
+                                                   for _ in range(args.calls)])
+    return results
+
+
+def git_commit():
+    """Returns the current git commit, or None if it cannot be determined."""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, previous):
+    """Prints the change in p50 latency and throughput with respect to a previous run."""
+    print("{:<28} {:>12} {:>12}".format('benchmark', 'p50 change', 'throughput'))
+    for name, values in results['benchmarks'].items():
+        if name in previous['benchmarks']:
+            old = previous['benchmarks'][name]
+            print("{:<28} {:>11.1f}% {:>11.2f}x".format(name, 100 * (values['p50_ms'] / old['p50_ms'] - 1),
+                                                       values['throughput'] / old['throughput']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the calendar backend and its HTTP API')
+    parser.add_argument('--users', type=int, default=50, help='Number of generated users')
+    parser.add_argument('--ranges', type=int, default=200, help='Number of ranges per user')
+    parser.add_argument('--length', type=int, default=8, help='Length of every range, in hours')
+    parser.add_argument('--panel', type=int, default=4, help='Number of people in every meeting')
+    parser.add_argument('--calls', type=int, default=50, help='Number of calls per benchmark')
+    parser.add_argument('--seed', type=int, default=1, help='Seed for the random generator')
+    parser.add_argument('--bitmaps', action='store_true', help='Build the bitmap index before running the benchmarks')
+    parser.add_argument('--no-flask', dest='flask', action='store_false', help='Skip the benchmarks of the HTTP API')
+    parser.add_argument('--output', metavar='FILE', help='Save the results as JSON in this file')
+    parser.add_argument('--compare', metavar='FILE', help='Compare the results against a previously saved file')
+    args = parser.parse_args()
+    if args.panel > args.users:
+        parser.error('the panel cannot be larger than the number of users')
+
+    tmp = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+    tmp.close()
+    try:
+        cal = Calendar(tmp.name)
+        start = time.perf_counter()
+        users = generate(cal, args.users, args.ranges, args.length, args.seed)
+        generate_time = time.perf_counter() - start
+        if args.bitmaps:
+            cal.build_bitmap_index()
+        cal.close()
+
+        rng = random.Random(args.seed)
+        benchmarks = bench_backend(tmp.name, users, args, rng)
+        if args.flask:
+            benchmarks.update(bench_flask(tmp.name, users, args, rng))
+    finally:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(tmp.name + suffix):
+                os.unlink(tmp.name + suffix)
+
+    results = {'commit': git_commit(),
+               'date': datetime.now().isoformat(),
+               'python': platform.python_version(),
+               'parameters': {'users': args.users, 'ranges': args.ranges, 'length': args.length,
+                              'panel': args.panel, 'calls': args.calls, 'seed': args.seed, 'bitmaps': args.bitmaps},
+               'generate_seconds': generate_time,
+               'benchmarks': benchmarks}
+
+    print("{:<28} {:>12} {:>10} {:>10} {:>12}".format('benchmark', 'calls/s', 'p50 ms', 'p99 ms', 'peak KiB'))
+    for name, values in benchmarks.items():
+        print("{:<28} {:>12.1f} {:>10.3f} {:>10.3f} {:>12.1f}".format(name, values['throughput'], values['p50_ms'],
+                                                                      values['p99_ms'], values['peak_kib']))
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump(results, outfile, indent=2)
+    if args.compare:
+        with open(args.compare) as infile:
+            previous = json.load(infile)
+        if previous['parameters'] != results['parameters']:
+            print("Warning: the compared runs used different parameters", file=sys.stderr)
+        compare(results, previous)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+#!/usr/bin/python3
+
+import unittest
+from functools import reduce
+from intervals import SlotSet
+
+# Every bitmap covers one week, with one bit per hour. Weeks are counted from the epoch.
+WEEK_HOURS = 168
+WEEK_BYTES = WEEK_HOURS // 8
+
+
+def range_masks(hour_from, hour_to):
+    """Splits a range of hours into one bitmap per week.
+
+    Parameters
+    ----------
+    hour_from : int
+        The first hour of the range, in hours since the epoch.
+    hour_to : int
+        The first hour after the range.
+
+    Returns
+    -------
+    dict
+        Bitmaps (as integers) indexed by week. Bit `i` of a week is set if hour `i` of that week is in the range.
+    """
+    masks = dict()
+    hour = hour_from
+    while hour < hour_to:
+        week, offset = divmod(hour, WEEK_HOURS)
+        length = min(hour_to - hour, WEEK_HOURS - offset)
+        masks[week] = ((1 << length) - 1) << offset
+        hour += length
+    return masks
+
+
+def to_blob(bits):
+    """Converts a weekly bitmap into the bytes stored in the database."""
+    return bits.to_bytes(WEEK_BYTES, 'little')
+
+
+def from_blob(blob):
+    """Converts the bytes stored in the database into a weekly bitmap."""
+    return int.from_bytes(blob, 'little')
+
+
+def intersect_bitmaps(people):
+    """Calculates the hours available to everyone from their weekly bitmaps.
+
+    Parameters
+    ----------
+    people : list of dict
+        One dictionary per person, with their bitmaps indexed by week. Weeks without a bitmap are empty.
+
+    Returns
+    -------
+    SlotSet
+        The hours whose bits are set for every person.
+
+    Notes
+    -----
+    Only the weeks that appear for every person can have common hours. The bitmaps of those weeks are
+    concatenated into a single integer per person, so that the intersection of a whole panel is one
+    integer AND per person, done by Python a machine word at a time.
+    """
+    if len(people) == 0:
+        return SlotSet()
+    weeks = sorted(reduce(lambda common, bitmaps: common.intersection(bitmaps), people[1:], set(people[0])))
+    common = None
+    for bitmaps in people:
+        packed = 0
+        for position, week in enumerate(weeks):
+            packed |= bitmaps[week] << (position * WEEK_HOURS)
+        common = packed if common is None else common & packed
+    return bits_to_slots(common, weeks)
+
+
+def bits_to_slots(packed, weeks):
+    """Converts a concatenation of weekly bitmaps back into a `SlotSet`.
+
+    Parameters
+    ----------
+    packed : int
+        The bitmaps of `weeks`, concatenated in the same order (the first week in the lowest bits).
+    weeks : list(int)
+        The week of every bitmap in `packed`.
+    """
+    ranges = []
+    base = 0
+    while packed:
+        # Skip to the next set bit, and measure the run of set bits that starts there
+        skip = (packed & -packed).bit_length() - 1
+        packed >>= skip
+        base += skip
+        run = (~packed & (packed + 1)).bit_length() - 1
+        packed >>= run
+        # A run can span several weeks, but they are only consecutive hours if the weeks are consecutive
+        position = base
+        while position < base + run:
+            index, offset = divmod(position, WEEK_HOURS)
+            length = min(base + run - position, WEEK_HOURS - offset)
+            ranges.append((weeks[index] * WEEK_HOURS + offset, weeks[index] * WEEK_HOURS + offset + length))
+            position += length
+        base += run
+    return SlotSet.from_sorted(ranges)
+
+
+class TestCaseBitmaps(unittest.TestCase):
+    """Tests the conversion between ranges and weekly bitmaps."""
+    def bitmaps(self, ranges):
+        retval = dict()
+        for hour_from, hour_to in ranges:
+            for week, mask in range_masks(hour_from, hour_to).items():
+                retval[week] = retval.get(week, 0) | mask
+        return retval
+
+    def testRoundTrip(self):
+        ranges = [(5, 10), (160, 340), (1000, 1001), (1007, 1200)]
+        bitmaps = self.bitmaps(ranges)
+        self.assertEqual(sorted(bitmaps), [0, 1, 2, 5, 6, 7])
+        self.assertEqual(from_blob(to_blob(bitmaps[1])), bitmaps[1])
+        self.assertEqual(list(intersect_bitmaps([bitmaps])), ranges)
+
+    def testIntersection(self):
+        first = [(5, 10), (160, 340), (1000, 1200)]
+        second = [(0, 6), (9, 200), (300, 1005), (1100, 1101)]
+        expected = SlotSet.from_ranges(first).intersection(SlotSet.from_ranges(second))
+        self.assertEqual(intersect_bitmaps([self.bitmaps(first), self.bitmaps(second)]), expected)
+        self.assertEqual(intersect_bitmaps([self.bitmaps(first), {}]), SlotSet())
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
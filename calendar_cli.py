@@ -1,9 +1,117 @@
 #!/usr/bin/python3
 
 import argparse
-import dateutil.parser
+import csv
+import itertools
+import json
 import sys
 from backend import Calendar
+from datecodec import parse_date, parse_datetime
+
+# Number of rows that are added to the database in a single transaction when importing a file
+IMPORT_BATCH_SIZE = 5000
+
+
+def format_slot(slot):
+    """Formats a slot for printing. Ranges are printed as ISO 8601 intervals (FROM/TO)."""
+    if isinstance(slot, list):
+        return '/'.join(slot)
+    return slot
+
+
+def read_import_rows(filename):
+    """Reads the rows of a file to import, one at a time.
+
+    CSV files have one row per user (`user_id,name`) or per slot (`user_id,from,to`).
+    JSONL files have one object per line, with the fields `user_id` and `name` for users,
+    or `user_id`, `from`, and `to` for slots.
+
+    Yields
+    ------
+    tuple(int, str, tuple)
+        The line number, the kind of row ('user', 'slot', or None if the row is not valid), and its values.
+    """
+    with open(filename, newline='') as infile:
+        if filename.endswith('.jsonl'):
+            for line_num, line in enumerate(infile, 1):
+                if line.strip() == '':
+                    continue
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    row = None
+                if isinstance(row, dict) and 'name' in row:
+                    yield line_num, 'user', (row.get('user_id'), row['name'])
+                elif isinstance(row, dict) and 'from' in row:
+                    yield line_num, 'slot', (row.get('user_id'), parse_date(row['from']), parse_date(row.get('to')))
+                else:
+                    yield line_num, None, ()
+        else:
+            reader = csv.reader(infile)
+            for row in reader:
+                if len(row) == 2:
+                    yield reader.line_num, 'user', (row[0], row[1])
+                elif len(row) == 3:
+                    yield reader.line_num, 'slot', (row[0], parse_date(row[1]), parse_date(row[2]))
+                elif len(row) > 0:
+                    yield reader.line_num, None, ()
+
+
+def import_file(cal, filename):
+    """Imports users and slots from a CSV or JSONL file.
+
+    The file is read in batches of `IMPORT_BATCH_SIZE` rows, and every batch is added in a single transaction.
+    Users are added before slots within a batch. Rows that cannot be added are reported on stderr.
+
+    Returns
+    -------
+    bool
+        True if every row was imported, False otherwise.
+    """
+    success = True
+    rows = read_import_rows(filename)
+    while True:
+        batch = list(itertools.islice(rows, IMPORT_BATCH_SIZE))
+        if len(batch) == 0:
+            break
+        for line_num, kind, _ in batch:
+            if kind is None:
+                print("Error in line {}: unknown row format".format(line_num), file=sys.stderr)
+                success = False
+        for kind, add_bulk in (('user', cal.add_users_bulk), ('slot', cal.add_slots_bulk)):
+            lines = [line_num for line_num, row_kind, _ in batch if row_kind == kind]
+            retval = add_bulk([values for _, row_kind, values in batch if row_kind == kind])
+            for error in retval['errors']:
+                print("Error in line {}: {}".format(lines[error['index']], error['desc']), file=sys.stderr)
+            if retval['code'] != 0:
+                success = False
+    return success
+
+
+def schedule_file(cal, filename, start=None, end=None, duration=1):
+    """Schedules the meetings in a CSV file, with one meeting per row (`interviewee,interviewer,...`).
+
+    Every scheduled meeting is printed as `interviewee,interviewer,...,FROM/TO`. Meetings that are not valid
+    or cannot be scheduled are reported on stderr.
+
+    Returns
+    -------
+    bool
+        True if every meeting was scheduled, False otherwise.
+    """
+    with open(filename, newline='') as infile:
+        reader = csv.reader(infile)
+        rows = [(reader.line_num, row) for row in reader if len(row) > 0]
+    retval = cal.schedule_meetings([(row[0], row[1:]) for _, row in rows], start, end, duration)
+    if retval['code'] == 8:
+        print("Error scheduling meetings: {}".format(retval['desc']), file=sys.stderr)
+        return False
+    for (line_num, row), result in zip(rows, retval['data']):
+        if result['code'] == 0:
+            print("{},{}".format(','.join(row), format_slot(result['data'])))
+        else:
+            print("Error in line {}: {}".format(line_num, result['desc']), file=sys.stderr)
+    return all(result['code'] == 0 for result in retval['data'])
 
 # Parse arguments for the program
 long_date_desc = 'Dates are expected and provided in ISO 8601 format (YYYY-MM-DDTHH:MM:SS), ' \
@@ -24,6 +132,26 @@ group.add_argument('--see_slots', dest='see_slots', metavar='USER_ID',
                    help='See the available slots for the selected user')
 group.add_argument('--meeting', dest='meeting_members', metavar='USER_ID', nargs='+',
                    help='Show possible meeting dates. See below for the proper date format.')
+group.add_argument('--build_index', dest='build_index', action='store_true',
+                   help='Build (or rebuild) the bitmap index used to calculate meetings')
+group.add_argument('--compact', dest='compact', action='store_true',
+                   help='Merge the overlapping and adjacent slots stored by older versions')
+group.add_argument('--import', dest='import_file', metavar='FILE',
+                   help='Add the users and slots of a CSV or JSONL file to the database')
+group.add_argument('--schedule', dest='schedule_file', metavar='FILE',
+                   help='Assign non-overlapping times to the meetings of a CSV file')
+
+# Options that restrict the time window of --see_slots, --meeting and --schedule
+parser.add_argument('--start', dest='start', metavar='DATE', type=parse_datetime,
+                    help='Only show slots that start at or after this date')
+parser.add_argument('--end', dest='end', metavar='DATE', type=parse_datetime,
+                    help='Only show slots that start before this date')
+parser.add_argument('--limit', dest='limit', metavar='N', type=int,
+                    help='Only show the N earliest meeting slots')
+parser.add_argument('--min_hours', dest='min_hours', metavar='N', type=int, default=1,
+                    help='Duration of the meeting, in hours (default: 1)')
+parser.add_argument('--format', dest='format', choices=Calendar.FORMATS, default='hours',
+                    help='Show one slot per hour (the default), or merged FROM/TO ranges')
 
 args = parser.parse_args()
 
@@ -44,26 +172,49 @@ elif args.get_user:
 elif args.add_slot:
     # Add a slot to the database
     retval = cal.add_slots(args.add_slot[0],
-                           dateutil.parser.parse(args.add_slot[1]),
-                           dateutil.parser.parse(args.add_slot[2]))
+                           parse_datetime(args.add_slot[1]),
+                           parse_datetime(args.add_slot[2]))
     if retval['code'] != 0:
         print("Error adding slot: {}".format(retval['desc']), file=sys.stderr)
+elif args.build_index:
+    # Build the optional bitmap index
+    retval = cal.build_bitmap_index()
+    if retval['code'] != 0:
+        print("Error building index: {}".format(retval['desc']), file=sys.stderr)
+elif args.compact:
+    # Merge the slots of every user
+    retval = cal.compact()
+    if retval['code'] == 0:
+        print("Compacted {} slots into {}".format(retval['before'], retval['after']))
+    else:
+        print("Error compacting slots: {}".format(retval['desc']), file=sys.stderr)
+elif args.import_file:
+    # Add the contents of a file to the database
+    if not import_file(cal, args.import_file):
+        sys.exit(1)
+elif args.schedule_file:
+    # Schedule a batch of meetings without conflicts
+    if not schedule_file(cal, args.schedule_file, args.start, args.end, args.min_hours):
+        sys.exit(1)
 elif args.see_slots:
-    # Query available slots for a specific user
-    retval = cal.get_slots (args.see_slots)
+    # Query available slots for a specific user, printing them as they are read
+    retval = cal.check_slots(args.start, args.end, args.format)
     if retval['code'] == 0:
-        for slot in retval['data']:
-            print(slot)
+        for slot in cal.iter_slots(args.see_slots, args.start, args.end, args.format):
+            print(format_slot(slot))
     else:
         print("Error querying slots: {}".format(retval['desc']), file=sys.stderr)
 elif args.meeting_members:
     # Organize a meeting with a list of members
-    retval = cal.organize_meeting(args.meeting_members[0], args.meeting_members[1:])
+    meeting = (args.meeting_members[0], args.meeting_members[1:], args.start, args.end,
+               args.format, args.limit, args.min_hours)
+    retval = cal.check_meeting_query(*meeting)
     if retval['code'] == 0:
-        if len(retval['data']) == 0:
+        found = False
+        for slot in cal.iter_meeting(*meeting):
+            print(format_slot(slot))
+            found = True
+        if not found:
             print("No possible common schedule found")
-        else:
-            for slot in retval['data']:
-                print(slot)
     else:
         print("Error querying meeting user: {}".format(retval['desc']), file=sys.stderr)
@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+
+import unittest
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+
+# Dates are stored and returned as naive UTC datetimes, in the format YYYY-MM-DDTHH:MM:SS
+EPOCH = datetime(1970, 1, 1)
+HOUR = timedelta(seconds=3600)
+
+# The part of an hour string after the day, for every hour of a day
+HOUR_SUFFIXES = tuple('T{:02d}:00:00'.format(hour) for hour in range(24))
+
+
+def to_utc(date):
+    """Converts an aware datetime into a naive datetime in UTC. Naive datetimes are returned unchanged."""
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date
+
+
+def to_timestamp(date):
+    """Converts a datetime into seconds since the epoch.
+
+    Naive datetimes are assumed to be in UTC, while aware datetimes are converted to UTC first.
+    """
+    return (to_utc(date) - EPOCH) // timedelta(seconds=1)
+
+
+@lru_cache(maxsize=4096)
+def format_day(day):
+    """Returns the ISO 8601 representation (YYYY-MM-DD) of a day, given as days since the epoch."""
+    return (EPOCH + timedelta(days=day)).date().isoformat()
+
+
+def format_hour(hour):
+    """Returns the ISO 8601 representation of an hour, given as hours since the epoch.
+
+    Only the day is formatted by `datetime`, and it is cached, so consecutive hours are built by
+    concatenating two strings.
+    """
+    day, hour = divmod(hour, 24)
+    return format_day(day) + HOUR_SUFFIXES[hour]
+
+
+def parse_datetime(value):
+    """Parses a date, raising ValueError if it is not valid.
+
+    Dates in ISO 8601 format are parsed by `datetime.fromisoformat`. Any other format is parsed by
+    `dateutil`, which is only imported the first time such a date is found.
+    """
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        pass
+    import dateutil.parser
+    try:
+        return dateutil.parser.parse(value)
+    except OverflowError as error:
+        raise ValueError(str(error))
+
+
+def parse_date(value):
+    """Parses a date sent by a user, returning None if it is missing or not a valid date."""
+    if not isinstance(value, str):
+        return None
+    try:
+        return parse_datetime(value)
+    except ValueError:
+        return None
+
+
+class TestCaseDateCodec(unittest.TestCase):
+    """Compares the fast paths of the codec against the generic `datetime` methods."""
+    def testFormat(self):
+        for hour in list(range(-50, 50)) + list(range(429000, 430000, 7)):
+            self.assertEqual(format_hour(hour), (EPOCH + hour * HOUR).isoformat())
+
+    def testParse(self):
+        self.assertEqual(parse_date('2018-12-12T14:00:00'), datetime(2018, 12, 12, 14))
+        self.assertEqual(parse_date('2018-12-12T14:30:00+01:00'),
+                         datetime(2018, 12, 12, 14, 30, tzinfo=timezone(timedelta(hours=1))))
+        self.assertEqual(parse_date('2018/12/12 06:20'), datetime(2018, 12, 12, 6, 20),
+                         'Other formats should still be parsed')
+        for value in ('not a date', '', None, 12, '99999999999999999999'):
+            self.assertIsNone(parse_date(value), 'Invalid dates should be rejected: {!r}'.format(value))
+        self.assertRaises(ValueError, parse_datetime, 'not a date')
+        self.assertEqual(to_timestamp(parse_date('1970-01-01T01:00:00+01:00')), 0)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -1,18 +1,111 @@
 #!/usr/bin/python3
 
-import dateutil.parser
-from backend import Calendar
-from flask import Flask, request, abort
+import json
+import threading
+from flask import Flask, Response, g, request, abort, stream_with_context
 from flask_restful import Resource, Api
+from flask_restful.representations.json import output_json
+from metrics import METRICS
+from server_common import create_pool, create_batch_executor, configure_metrics, parse_date, parse_window, \
+    parse_meeting_options, parse_meetings, parse_schedule, wants_stream, batch_rows, add_batch, METRICS_CONTENT_TYPE
 
 app = Flask(__name__)
 api = Api(app)
-DATABASE = 'database.db'
+# Created on the first request, so that importing this module does not open the database
+pool = None
+pool_lock = threading.Lock()
+batch_executor = create_batch_executor()
+configure_metrics()
+
+
+@app.before_request
+def begin_metrics():
+    rule = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    g.metrics_call = METRICS.begin('{} {}'.format(request.method, rule))
+
+
+@app.after_request
+def record_status(response):
+    g.metrics_status = response.status_code
+    if response.is_streamed:
+        # Streamed responses are still being produced after the request is torn down
+        response.call_on_close(lambda started=g.pop('metrics_call', None): METRICS.end(started, response.status_code))
+    return response
+
+
+@app.teardown_request
+def end_metrics(exc):
+    METRICS.end(g.pop('metrics_call', None), g.pop('metrics_status', 500))
+
+
+def get_pool():
+    """Returns the pool of calendars of the server, creating it if needed."""
+    global pool
+    with pool_lock:
+        if pool is None:
+            pool = create_pool()
+        return pool
+
+
+def get_calendar():
+    """Returns the calendar of the current request, taking it from the pool the first time it is needed.
+
+    The calendar is given back when the request is torn down, or once a streamed response is closed.
+    """
+    if 'calendar' not in g:
+        g.calendar = get_pool().acquire()
+    return g.calendar
+
+
+@app.after_request
+def defer_release(response):
+    if response.is_streamed and 'calendar' in g:
+        # The stream keeps reading from the calendar after the request is torn down
+        response.call_on_close(lambda calendar=g.pop('calendar'): get_pool().release(calendar))
+    return response
+
+
+@app.teardown_request
+def release_calendar(exc):
+    calendar = g.pop('calendar', None)
+    if calendar is not None:
+        get_pool().release(calendar)
+
+
+@api.representation('application/json')
+def timed_output_json(data, code, headers=None):
+    """Encodes responses as flask_restful does by default, measuring the time it takes."""
+    with METRICS.phase('encode'):
+        return output_json(data, code, headers)
+
+
+@app.route('/metrics')
+def metrics():
+    return Response(METRICS.render(), content_type=METRICS_CONTENT_TYPE)
+
+
+def get_window():
+    """Reads the optional `start` and `end` query parameters of a request, aborting if they are not valid dates.
+
+    Returns
+    -------
+    tuple(datetime, datetime)
+        The start and the end of the window. Missing parameters are returned as None.
+    """
+    try:
+        return parse_window(request.args)
+    except ValueError:
+        abort(400)
+
+
+def stream_json(items):
+    """Builds a chunked response with one JSON value per line (NDJSON), serializing the items as they are consumed."""
+    return Response(stream_with_context(json.dumps(item) + '\n' for item in items), mimetype='application/x-ndjson')
 
 
 class People(Resource):
     def get(self, user_id):
-        cal = Calendar(DATABASE)
+        cal = get_calendar()
         retval = cal.get_user(user_id)
         if retval['data'] != '':
             return {'data': retval['data']}, 200
@@ -20,7 +113,7 @@ class People(Resource):
             abort(404)
 
     def post(self, user_id):
-        cal = Calendar(DATABASE)
+        cal = get_calendar()
         name = request.form.get('name')
         retval = cal.add_user(user_id, name)
         if retval['code'] != 0:
@@ -31,17 +124,27 @@ class People(Resource):
 
 class Slots(Resource):
     def get(self, user_id):
-        cal = Calendar(DATABASE)
-        retval = cal.get_slots(user_id)
-        return retval
+        cal = get_calendar()
+        start, end = get_window()
+        fmt = request.args.get('format', 'hours')
+        if wants_stream(request.args):
+            retval = cal.check_slots(start, end, fmt)
+            if retval['code'] == 0:
+                return stream_json(cal.iter_slots(user_id, start, end, fmt))
+            # Same body as the errors of `get_slots`
+            retval['data'] = []
+        else:
+            retval = cal.get_slots(user_id, start, end, fmt)
+        if retval['code'] != 0:
+            return retval, 400
+        else:
+            return retval
 
     def post(self, user_id):
-        cal = Calendar(DATABASE)
+        cal = get_calendar()
         date_from = request.form.get('from')
         date_to = request.form.get('to')
-        retval = cal.add_slots(user_id,
-                               dateutil.parser.parse(date_from),
-                               dateutil.parser.parse(date_to))
+        retval = cal.add_slots(user_id, parse_date(date_from), parse_date(date_to))
         if retval['code'] != 0:
             return retval, 400
         else:
@@ -50,9 +153,76 @@ class Slots(Resource):
 
 class Meeting(Resource):
     def get(self, user_ids):
-        cal = Calendar(DATABASE)
+        cal = get_calendar()
         users = user_ids.split(',')
-        retval = cal.organize_meeting(users[0], users[1:])
+        start, end = get_window()
+        try:
+            options = parse_meeting_options(request.args)
+        except ValueError:
+            abort(400)
+        if wants_stream(request.args):
+            retval = cal.check_meeting_query(users[0], users[1:], start, end, **options)
+            if retval['code'] == 0:
+                return stream_json(cal.iter_meeting(users[0], users[1:], start, end, **options))
+            # Same body as the errors of `organize_meeting`
+            retval['data'] = []
+        else:
+            retval = cal.organize_meeting(users[0], users[1:], start, end, **options)
+        if retval['code'] != 0:
+            return retval, 400
+        else:
+            return retval, 200
+
+
+class Meetings(Resource):
+    def post(self):
+        """Organizes many meetings at once. See `parse_meetings` for the format of the request."""
+        cal = get_calendar()
+        try:
+            meetings, options = parse_meetings(request.get_json(silent=True))
+        except ValueError:
+            abort(400)
+        retval = cal.organize_meetings(meetings, executor=batch_executor, **options)
+        if retval['code'] != 0:
+            return retval, 400
+        else:
+            return retval, 200
+
+
+class Schedule(Resource):
+    def post(self):
+        """Assigns non-overlapping times to many meetings. See `parse_schedule` for the format of the request."""
+        cal = get_calendar()
+        try:
+            meetings, options = parse_schedule(request.get_json(silent=True))
+        except ValueError:
+            abort(400)
+        retval = cal.schedule_meetings(meetings, executor=batch_executor, **options)
+        if retval['code'] != 0:
+            return retval, 400
+        else:
+            return retval, 200
+
+
+class CacheStats(Resource):
+    def get(self):
+        return get_pool().cache.stats(), 200
+
+
+class Batch(Resource):
+    def post(self):
+        """Adds many people and slots at once.
+
+        The request body is a JSON object with the optional lists `people` (objects with the fields
+        `user_id` and `name`) and `slots` (objects with the fields `user_id`, `from` and `to`).
+        People are added before slots, so new people can get slots in the same request.
+        """
+        cal = get_calendar()
+        try:
+            people, slots = batch_rows(request.get_json(silent=True))
+        except ValueError:
+            abort(400)
+        retval = add_batch(cal, people, slots)
         if retval['code'] != 0:
             return retval, 400
         else:
@@ -62,6 +232,10 @@ class Meeting(Resource):
 api.add_resource(People, '/people/<user_id>')
 api.add_resource(Slots, '/slots/<user_id>')
 api.add_resource(Meeting, '/meeting/<user_ids>')
+api.add_resource(Meetings, '/meetings')
+api.add_resource(Schedule, '/schedule')
+api.add_resource(Batch, '/batch')
+api.add_resource(CacheStats, '/cache')
 
 if __name__ == '__main__':
     app.run(port='5000')
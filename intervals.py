@@ -0,0 +1,246 @@
+#!/usr/bin/python3
+
+import heapq
+import random
+import unittest
+from array import array
+from datetime import datetime, timedelta
+from datecodec import EPOCH, HOUR, format_hour
+
+
+def sweep_intervals(interval_lists):
+    """Intersects the intervals of several people with a k-way sweep.
+
+    The input iterables are consumed lazily, so they can be read from a database cursor, and the
+    sweep stops reading as soon as the caller stops asking for intervals.
+
+    Parameters
+    ----------
+    interval_lists : list of iterable of (start, end)
+        One iterable per person, with intervals in the range [start, end). Each one must be sorted and
+        disjoint, as the ranges of a `SlotSet`.
+
+    Yields
+    ------
+    tuple(start, end)
+        Sorted, disjoint intervals that are contained in every one of the input lists.
+
+    Notes
+    -----
+    The sweep keeps a heap with the current interval of every person, ordered by end point. At
+    every step the common interval (if any) goes from the latest start to the earliest end, and the
+    person whose interval ends first advances to their next interval. The cost of the operation
+    is therefore O(n log k), where n is the total number of intervals and k the number of people.
+    """
+    if len(interval_lists) == 0:
+        return
+    iterators = [iter(intervals) for intervals in interval_lists]
+    heap = []
+    latest_start = None
+    for person, iterator in enumerate(iterators):
+        first = next(iterator, None)
+        if first is None:
+            return
+        start, end = first
+        heap.append((end, person))
+        if latest_start is None or start > latest_start:
+            latest_start = start
+    heapq.heapify(heap)
+
+    while True:
+        earliest_end, person = heap[0]
+        if latest_start < earliest_end:
+            yield latest_start, earliest_end
+        # The person whose interval finishes first moves on to their next one
+        following = next(iterators[person], None)
+        if following is None:
+            return
+        start, end = following
+        heapq.heapreplace(heap, (end, person))
+        if start > latest_start:
+            latest_start = start
+
+
+class SlotSet:
+    """A set of hours, stored as sorted and disjoint ranges of hours since the epoch.
+
+    The ranges are kept in two arrays of 64-bit integers (`starts` and `ends`), and every range covers
+    the hours in [start, end). Large calendars are therefore stored in a few bytes per range, rather
+    than in one string per hour, and dates are only created when the set is serialized.
+
+    Instances should be treated as immutable: all operations return a new set.
+    """
+    __slots__ = ('starts', 'ends')
+
+    def __init__(self, starts=(), ends=()):
+        """Initializes the set from already sorted, disjoint, and non-adjacent ranges.
+
+        Use `from_ranges` to build a set from arbitrary ranges.
+        """
+        self.starts = array('q', starts)
+        self.ends = array('q', ends)
+
+    @classmethod
+    def from_sorted(cls, ranges):
+        """Builds a set from ranges sorted by their start. Overlapping and adjacent ranges are merged."""
+        retval = cls()
+        starts = retval.starts
+        ends = retval.ends
+        for start, end in ranges:
+            if start >= end:
+                continue
+            if len(ends) > 0 and start <= ends[-1]:
+                if end > ends[-1]:
+                    ends[-1] = end
+            else:
+                starts.append(start)
+                ends.append(end)
+        return retval
+
+    @classmethod
+    def from_ranges(cls, ranges):
+        """Builds a set from ranges in any order."""
+        return cls.from_sorted(sorted(ranges))
+
+    def __len__(self):
+        """Returns the number of ranges in the set."""
+        return len(self.starts)
+
+    def __getitem__(self, index):
+        return self.starts[index], self.ends[index]
+
+    def __iter__(self):
+        return zip(self.starts, self.ends)
+
+    def __eq__(self, other):
+        return isinstance(other, SlotSet) and self.starts == other.starts and self.ends == other.ends
+
+    def __repr__(self):
+        return 'SlotSet({})'.format(list(self))
+
+    def count(self):
+        """Returns the number of hours in the set."""
+        return sum(self.ends) - sum(self.starts)
+
+    def union(self, *others):
+        """Returns the hours that are in this set or in any of the others."""
+        return SlotSet.from_sorted(heapq.merge(self, *others))
+
+    def intersection(self, *others):
+        """Returns the hours that are in this set and in all of the others."""
+        return SlotSet.from_sorted(sweep_intervals([self] + list(others)))
+
+    def clip(self, start=None, end=None):
+        """Returns the hours of this set in [start, end). A bound of None leaves that side open."""
+        retval = SlotSet()
+        for range_start, range_end in self:
+            if start is not None and range_start < start:
+                range_start = start
+            if end is not None and range_end > end:
+                range_end = end
+            if range_start < range_end:
+                retval.starts.append(range_start)
+                retval.ends.append(range_end)
+        return retval
+
+    def hours(self):
+        """Iterates over every hour in the set, as hours since the epoch."""
+        for start, end in self:
+            yield from range(start, end)
+
+    def to_hours(self):
+        """Returns every hour in the set as an ISO 8601 string."""
+        return [format_hour(hour) for hour in self.hours()]
+
+    def to_ranges(self):
+        """Returns the ranges of the set as [from, to) pairs of ISO 8601 strings."""
+        return [[format_hour(start), format_hour(end)] for start, end in self]
+
+
+def intersect_panels(panels, slot_sets):
+    """Intersects the available hours of many groups of people, sharing the work between groups.
+
+    Parameters
+    ----------
+    panels : list of tuple(str)
+        The people in every group. Groups that start with the same people share the intersection
+        of those people, which is only calculated once.
+    slot_sets : dict
+        The `SlotSet` of every person that appears in `panels`.
+
+    Returns
+    -------
+    list(SlotSet)
+        The hours in which everyone in each group is available, in the same order as `panels`.
+    """
+    partials = dict()
+    retval = []
+    for panel in panels:
+        # Start from the longest group of leading people whose intersection is already known
+        known = len(panel)
+        while known > 1 and panel[:known] not in partials:
+            known -= 1
+        current = partials[panel[:known]] if known > 1 else slot_sets[panel[0]]
+        for position in range(known, len(panel)):
+            current = current.intersection(slot_sets[panel[position]])
+            partials[panel[:position+1]] = current
+        retval.append(current)
+    return retval
+
+
+class TestCaseIntervals(unittest.TestCase):
+    """Tests the interval engine against a naive hour-by-hour count."""
+    @staticmethod
+    def count_hours(interval_lists):
+        # Reference implementation: one string per hour and person, counted in a dict
+        aggr_times = dict()
+        for intervals in interval_lists:
+            hours = set()
+            for start, end in intervals:
+                while start < end:
+                    hours.add(start.isoformat())
+                    start += timedelta(hours=1)
+            for hour in hours:
+                aggr_times[hour] = aggr_times.get(hour, 0) + 1
+        return sorted(hour for hour in aggr_times if aggr_times[hour] == len(interval_lists))
+
+    def testIntersect(self):
+        self.assertEqual(list(sweep_intervals([])), [])
+        self.assertEqual(list(sweep_intervals([[(0, 5)], []])), [])
+        self.assertEqual(list(sweep_intervals([[(0, 5), (7, 10)], [(3, 8)]])), [(3, 5), (7, 8)])
+        self.assertEqual(list(sweep_intervals([[(0, 5)], [(5, 10)]])), [], 'Touching intervals do not overlap')
+
+    def testSlotSet(self):
+        slots = SlotSet.from_ranges([(10, 12), (0, 2), (2, 3), (5, 7), (6, 9), (4, 4)])
+        self.assertEqual(list(slots), [(0, 3), (5, 9), (10, 12)], 'Ranges are not merged correctly')
+        self.assertEqual(slots.count(), 9)
+        other = SlotSet.from_ranges([(1, 6), (8, 11)])
+        self.assertEqual(list(slots.intersection(other)), [(1, 3), (5, 6), (8, 9), (10, 11)])
+        self.assertEqual(list(slots.union(other)), [(0, 12)])
+        self.assertEqual(list(slots.clip(1, 11)), [(1, 3), (5, 9), (10, 11)])
+        self.assertEqual(list(slots.clip()), list(slots), 'An open window should not change the set')
+        self.assertEqual(SlotSet.from_ranges([(427056, 427058)]).to_hours(), ['2018-09-20T00:00:00', '2018-09-20T01:00:00'])
+        self.assertEqual(SlotSet.from_ranges([(427056, 427058)]).to_ranges(), [['2018-09-20T00:00:00', '2018-09-20T02:00:00']])
+
+    def testRandomized(self):
+        rng = random.Random(1234)
+        base = datetime(2018, 11, 19)
+        for _ in range(50):
+            interval_lists = []
+            for _ in range(rng.randint(1, 8)):
+                intervals = []
+                hour = rng.randint(0, 48)
+                for _ in range(rng.randint(0, 30)):
+                    length = rng.randint(1, 12)
+                    intervals.append((base + timedelta(hours=hour), base + timedelta(hours=hour+length)))
+                    # Ranges may overlap or touch, and are merged by `SlotSet`
+                    hour += length + rng.randint(-3, 10)
+                rng.shuffle(intervals)
+                interval_lists.append(intervals)
+            # The ranges are stored as hours since the epoch
+            slot_sets = [SlotSet.from_ranges(((start - EPOCH) // HOUR, (end - EPOCH) // HOUR) for start, end in intervals)
+                         for intervals in interval_lists]
+            self.assertEqual(slot_sets[0].intersection(*slot_sets[1:]).to_hours(), self.count_hours(interval_lists))
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,161 @@
+#!/usr/bin/python3
+
+import threading
+import time
+import unittest
+from collections import OrderedDict
+
+
+class MeetingCache:
+    """In-process LRU cache for the results of meeting queries.
+
+    Results are keyed on the set of participants and on any other parameter of the query. Every user
+    has a version counter, which is increased whenever their data changes (see `touch`). An entry
+    remembers the versions of its participants at the time it was computed, and is discarded when
+    any of them changes. Entries are also discarded after `ttl` seconds, and the least recently used
+    entry is evicted when the cache is full.
+
+    Notes
+    -----
+    The version counters only see the writes done through this process. Writes done by other
+    processes are only noticed once the affected entries expire, so `ttl` bounds how stale a result
+    can be in a deployment with several worker processes.
+
+    All methods are thread-safe.
+    """
+    def __init__(self, maxsize=1024, ttl=60.0, clock=time.monotonic):
+        """Initializes the cache.
+
+        Parameters
+        ----------
+        maxsize : int, optional
+            The maximum number of entries kept in the cache.
+        ttl : float, optional
+            The number of seconds after which an entry expires.
+        clock : callable, optional
+            Function returning the current time in seconds. Only meant to be replaced by tests.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.versions = dict()
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0, 'invalidations': 0}
+
+    @staticmethod
+    def key(people, *params):
+        """Builds the key of a query. The order and repetition of the participants does not matter."""
+        return tuple(sorted(set(people))), params
+
+    def snapshot(self, key):
+        """Returns the current versions of the participants of a key.
+
+        The snapshot must be taken *before* the data for a query is read, and passed to `put` afterwards.
+        That way, a result computed while one of its participants was being modified is never served.
+        """
+        with self.lock:
+            return tuple(self.versions.get(person, 0) for person in key[0])
+
+    def get(self, key):
+        """Returns the cached result for a key, or None if there is no valid entry for it."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.counters['misses'] += 1
+                return None
+            versions, expires, result = entry
+            if expires <= self.clock():
+                del self.entries[key]
+                self.counters['expirations'] += 1
+                self.counters['misses'] += 1
+                return None
+            if versions != tuple(self.versions.get(person, 0) for person in key[0]):
+                del self.entries[key]
+                self.counters['invalidations'] += 1
+                self.counters['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.counters['hits'] += 1
+            return result
+
+    def put(self, key, versions, result):
+        """Stores the result of a query.
+
+        Parameters
+        ----------
+        key : tuple
+            The key of the query, as returned by `key`.
+        versions : tuple
+            The versions of the participants before the result was computed, as returned by `snapshot`.
+        result : object
+            The result of the query. It should not be modified afterwards.
+        """
+        with self.lock:
+            self.entries[key] = (versions, self.clock() + self.ttl, result)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.counters['evictions'] += 1
+
+    def touch(self, user_id):
+        """Marks the data of a user as modified, invalidating every entry in which they participate."""
+        with self.lock:
+            self.versions[user_id] = self.versions.get(user_id, 0) + 1
+
+    def stats(self):
+        """Returns the hit, miss, eviction, expiration, and invalidation counts, and the current size."""
+        with self.lock:
+            retval = dict(self.counters)
+            retval['size'] = len(self.entries)
+            retval['maxsize'] = self.maxsize
+            return retval
+
+
+class TestCaseMeetingCache(unittest.TestCase):
+    """Tests the eviction and invalidation rules of the cache."""
+    def setUp(self):
+        self.now = 0.0
+        self.cache = MeetingCache(maxsize=2, ttl=10.0, clock=lambda: self.now)
+
+    def store(self, people, result):
+        key = MeetingCache.key(people)
+        self.cache.put(key, self.cache.snapshot(key), result)
+
+    def testKey(self):
+        self.assertEqual(MeetingCache.key(['b', 'a', 'a'], 1), MeetingCache.key(['a', 'b'], 1))
+        self.assertNotEqual(MeetingCache.key(['a', 'b'], 1), MeetingCache.key(['a', 'b'], 2))
+
+    def testEviction(self):
+        self.store(['a', 'b'], 1)
+        self.store(['a', 'c'], 2)
+        self.assertEqual(self.cache.get(MeetingCache.key(['a', 'b'])), 1)
+        # 'a,c' is now the least recently used entry
+        self.store(['b', 'c'], 3)
+        self.assertIsNone(self.cache.get(MeetingCache.key(['a', 'c'])), 'The LRU entry was not evicted')
+        self.assertEqual(self.cache.get(MeetingCache.key(['b', 'c'])), 3)
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions']), (2, 1, 1))
+
+    def testExpiration(self):
+        self.store(['a', 'b'], 1)
+        self.now = 10.0
+        self.assertIsNone(self.cache.get(MeetingCache.key(['a', 'b'])), 'Expired entries should not be served')
+        self.assertEqual(self.cache.stats()['expirations'], 1)
+
+    def testInvalidation(self):
+        self.store(['a', 'b'], 1)
+        self.store(['c', 'd'], 2)
+        self.cache.touch('b')
+        self.assertIsNone(self.cache.get(MeetingCache.key(['a', 'b'])), 'Entries of modified users should not be served')
+        self.assertEqual(self.cache.get(MeetingCache.key(['c', 'd'])), 2, 'Other entries should still be valid')
+        # A result computed before a modification must not be served after it
+        key = MeetingCache.key(['c', 'd'])
+        versions = self.cache.snapshot(key)
+        self.cache.touch('c')
+        self.cache.put(key, versions, 3)
+        self.assertIsNone(self.cache.get(key), 'Results computed before a modification should not be served')
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,256 @@
+#!/usr/bin/python3
+
+import contextvars
+import logging
+import threading
+import time
+import unittest
+from contextlib import nullcontext
+
+# Upper bounds (in seconds) of the buckets of every latency histogram
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Help text of every metric exported by `Metrics.render`
+HELP = {
+    'calendar_request_seconds': ('histogram', 'Latency of the requests, by endpoint and status.'),
+    'calendar_phase_seconds': ('histogram', 'Time spent in every phase of a request, by endpoint.'),
+    'calendar_items_total': ('counter', 'Rows read from the database and slots returned, by endpoint.'),
+    'calendar_slow_calls_total': ('counter', 'Requests slower than the slow-call threshold, by endpoint.'),
+}
+
+# The call being measured in the current thread or task, as a `CallRecord`
+CURRENT_CALL = contextvars.ContextVar('current_call', default=None)
+
+# Phases and counts outside of any measured call (e.g. in the CLI) are reported under this endpoint
+NO_ENDPOINT = 'none'
+
+# Returned by `Metrics.phase` when metrics are disabled
+NULL_PHASE = nullcontext()
+
+slow_log = logging.getLogger('calendar.slow')
+
+
+class CallRecord:
+    """The phases and counts of a single call, kept for the slow-call log."""
+    __slots__ = ('endpoint', 'start', 'phases', 'counts')
+
+    def __init__(self, endpoint, start):
+        self.endpoint = endpoint
+        self.start = start
+        self.phases = dict()
+        self.counts = dict()
+
+    def summary(self):
+        """Describes the phases and counts of the call, e.g. `sql=1.2ms expand=0.3ms rows=10 slots=24`."""
+        parts = ['{}={:.1f}ms'.format(phase, 1000 * seconds) for phase, seconds in self.phases.items()]
+        parts.extend('{}={}'.format(kind, value) for kind, value in self.counts.items())
+        return ' '.join(parts)
+
+
+class Phase:
+    """Context manager that adds the time spent inside it to a phase of the current call."""
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = self.metrics.clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.add_phase(self.name, self.metrics.clock() - self.start)
+        return False
+
+
+class Metrics:
+    """Collects latency histograms, phase timings, and row and slot counts, and exports them for Prometheus.
+
+    Requests are measured between `begin` and `end`. Inside them, code marks its phases with `phase` and
+    reports how much data it handled with `count`. Both are attributed to the request that is running in the
+    current thread or task, so they can be broken down by endpoint. Requests slower than `slow_threshold`
+    are logged with the time spent in every phase.
+
+    Notes
+    -----
+    While disabled, `phase` returns a shared no-op context manager and every other method returns
+    immediately, so instrumented code only pays for a method call.
+
+    All methods are thread-safe.
+    """
+    def __init__(self, enabled=False, slow_threshold=None, clock=time.perf_counter):
+        """Initializes the metrics.
+
+        Parameters
+        ----------
+        enabled : bool, optional
+            Whether to collect anything.
+        slow_threshold : float, optional
+            If given, requests that take at least this many seconds are logged on the `calendar.slow` logger.
+        clock : callable, optional
+            Function returning the current time in seconds. Only meant to be replaced by tests.
+        """
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.histograms = dict()
+        self.counters = dict()
+        self.configure(enabled, slow_threshold)
+
+    def configure(self, enabled, slow_threshold=None):
+        """Enables or disables the metrics. A slow-call threshold enables them too."""
+        self.slow_threshold = slow_threshold
+        self.enabled = enabled or slow_threshold is not None
+
+    def begin(self, endpoint):
+        """Starts measuring a request to an endpoint.
+
+        Returns
+        -------
+        object
+            A token that must be passed to `end`, in the same thread or task.
+        """
+        if not self.enabled:
+            return None
+        record = CallRecord(endpoint, self.clock())
+        return record, CURRENT_CALL.set(record)
+
+    def end(self, started, status=''):
+        """Finishes measuring a request, given the token returned by `begin`."""
+        if started is None:
+            return
+        record, token = started
+        elapsed = self.clock() - record.start
+        try:
+            CURRENT_CALL.reset(token)
+        except ValueError:
+            # The request ended in another context (e.g. a stream closed by the server), where it is not current
+            pass
+        self.observe('calendar_request_seconds', (('endpoint', record.endpoint), ('status', str(status))), elapsed)
+        if self.slow_threshold is not None and elapsed >= self.slow_threshold:
+            self.increment('calendar_slow_calls_total', (('endpoint', record.endpoint),), 1)
+            slow_log.warning("Slow call to %s: %.1f ms (%s)", record.endpoint, 1000 * elapsed, record.summary())
+
+    def phase(self, name):
+        """Returns a context manager that measures a phase of the current request (e.g. 'sql' or 'encode')."""
+        if not self.enabled:
+            return NULL_PHASE
+        return Phase(self, name)
+
+    def add_phase(self, name, seconds):
+        record = CURRENT_CALL.get()
+        endpoint = NO_ENDPOINT
+        if record is not None:
+            record.phases[name] = record.phases.get(name, 0.0) + seconds
+            endpoint = record.endpoint
+        self.observe('calendar_phase_seconds', (('endpoint', endpoint), ('phase', name)), seconds)
+
+    def count(self, kind, value):
+        """Adds to the number of items (e.g. 'rows' or 'slots') handled by the current request."""
+        if not self.enabled:
+            return
+        record = CURRENT_CALL.get()
+        endpoint = NO_ENDPOINT
+        if record is not None:
+            record.counts[kind] = record.counts.get(kind, 0) + value
+            endpoint = record.endpoint
+        self.increment('calendar_items_total', (('endpoint', endpoint), ('kind', kind)), value)
+
+    def observe(self, name, labels, value):
+        with self.lock:
+            histogram = self.histograms.get((name, labels))
+            if histogram is None:
+                # One count per bucket, followed by the sum and the total count
+                histogram = self.histograms[(name, labels)] = [0] * len(BUCKETS) + [0.0, 0]
+            for position, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    histogram[position] += 1
+                    break
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def increment(self, name, labels, value):
+        with self.lock:
+            self.counters[(name, labels)] = self.counters.get((name, labels), 0) + value
+
+    def render(self):
+        """Returns every metric in the Prometheus text exposition format."""
+        with self.lock:
+            histograms = {key: list(values) for key, values in self.histograms.items()}
+            counters = dict(self.counters)
+        lines = []
+        for name, (kind, description) in HELP.items():
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for (metric, labels), values in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, bucket in zip(BUCKETS, values):
+                    cumulative += bucket
+                    lines.append('{}_bucket{} {}'.format(name, format_labels(labels + (('le', repr(bound)),)),
+                                                         cumulative))
+                lines.append('{}_bucket{} {}'.format(name, format_labels(labels + (('le', '+Inf'),)), values[-1]))
+                lines.append('{}_sum{} {!r}'.format(name, format_labels(labels), values[-2]))
+                lines.append('{}_count{} {}'.format(name, format_labels(labels), values[-1]))
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append('{}{} {}'.format(name, format_labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    """Formats label pairs as `{name="value",...}`, escaping the values as Prometheus expects."""
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join('{}="{}"'.format(name, value) for (name, _), value in zip(labels, escaped)) + '}'
+
+
+# Metrics of this process. Disabled until a server configures them.
+METRICS = Metrics()
+
+
+class TestCaseMetrics(unittest.TestCase):
+    """Tests the collection and export of metrics with a fake clock."""
+    def setUp(self):
+        self.now = 0.0
+        self.metrics = Metrics(enabled=True, slow_threshold=0.5, clock=lambda: self.now)
+
+    def testDisabled(self):
+        metrics = Metrics()
+        self.assertIs(metrics.phase('sql'), NULL_PHASE, 'Disabled metrics should not measure phases')
+        self.assertIsNone(metrics.begin('GET /people'))
+        metrics.count('rows', 10)
+        self.assertNotIn('calendar_items_total{', metrics.render(), 'Disabled metrics should not count anything')
+
+    def testRequest(self):
+        started = self.metrics.begin('GET /slots/<user_id>')
+        with self.metrics.phase('sql'):
+            self.now += 0.002
+        self.metrics.count('rows', 3)
+        self.now += 0.001
+        self.metrics.end(started, 200)
+        text = self.metrics.render()
+        labels = 'endpoint="GET /slots/<user_id>"'
+        self.assertIn('calendar_request_seconds_bucket{' + labels + ',status="200",le="0.0025"} 0', text)
+        self.assertIn('calendar_request_seconds_bucket{' + labels + ',status="200",le="0.005"} 1', text)
+        self.assertIn('calendar_request_seconds_count{' + labels + ',status="200"} 1', text)
+        self.assertIn('calendar_phase_seconds_count{' + labels + ',phase="sql"} 1', text)
+        self.assertIn('calendar_items_total{' + labels + ',kind="rows"} 3', text)
+        self.assertIsNone(CURRENT_CALL.get(), 'The request should not be current after it ends')
+
+    def testSlowLog(self):
+        started = self.metrics.begin('GET /meeting/<user_ids>')
+        with self.metrics.phase('intersect'):
+            self.now += 0.75
+        self.metrics.count('slots', 2)
+        with self.assertLogs('calendar.slow', level='WARNING') as logs:
+            self.metrics.end(started, 200)
+        self.assertIn('GET /meeting/<user_ids>: 750.0 ms (intersect=750.0ms slots=2)', logs.output[0])
+        self.assertIn('calendar_slow_calls_total{endpoint="GET /meeting/<user_ids>"} 1', self.metrics.render())
+
+    def testLabels(self):
+        self.assertEqual(format_labels((('endpoint', 'a"b\\c'),)), '{endpoint="a\\"b\\\\c"}')
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
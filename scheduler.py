@@ -0,0 +1,262 @@
+#!/usr/bin/python3
+
+import heapq
+import itertools
+import random
+import time
+import unittest
+from collections import defaultdict
+from intervals import SlotSet
+
+# Default number of hours tried when moving meetings to make room for others, in a whole batch
+REPAIR_LIMIT = 10000
+
+
+class MeetingScheduler:
+    """Assigns non-overlapping hours to a batch of meetings.
+
+    Every meeting has a group of people and the hours in which all of them are available. A person
+    cannot be in two meetings at the same time, so every assigned hour is removed from the options
+    of the other meetings of the same people.
+
+    Meetings are placed in order of fewest remaining options (the "minimum remaining values" rule of
+    constraint propagation), each one at its earliest remaining hour. When a meeting runs out of
+    options, the scheduler tries to move a single meeting that blocks one of its original hours to
+    another hour. Meetings that cannot be placed that way are reported as unplaced. The hours tried by
+    those moves are limited for the whole batch, so overbooked batches do not take longer than the
+    placement itself by more than a fixed amount.
+    """
+    def __init__(self, panels, available, duration=1, repair_limit=REPAIR_LIMIT):
+        """Initializes the scheduler.
+
+        Parameters
+        ----------
+        panels : list of tuple(str)
+            The people in every meeting.
+        available : list(SlotSet)
+            The hours in which everyone in each meeting is available, in the same order as `panels`.
+        duration : int, optional
+            The length of every meeting, in hours.
+        repair_limit : int, optional
+            The maximum number of hours tried when moving meetings, for all the unplaced meetings together.
+        """
+        self.panels = panels
+        self.duration = duration
+        self.repair_limit = repair_limit
+        # Hours that `repair` can still try
+        self.budget = repair_limit
+        # Hours at which every meeting can start, and the ones that are still free
+        self.candidates = [[hour for range_from, range_to in slots
+                            for hour in range(range_from, range_to - duration + 1)] for slots in available]
+        self.options = [frozenset(starts) for starts in self.candidates]
+        self.domains = [set(starts) for starts in self.candidates]
+        self.assignment = [None] * len(panels)
+        # Hours in which every person is busy, with the meeting they are busy with
+        self.busy = defaultdict(dict)
+        meetings_by_person = defaultdict(list)
+        for index, panel in enumerate(panels):
+            for person in set(panel):
+                meetings_by_person[person].append(index)
+        self.neighbours = [set(itertools.chain.from_iterable(meetings_by_person[person] for person in set(panel)))
+                           - {index} for index, panel in enumerate(panels)]
+        self.pending = set(range(len(panels)))
+        self.queue = [(len(domain), index) for index, domain in enumerate(self.domains)]
+        heapq.heapify(self.queue)
+
+    def hours(self, start):
+        return range(start, start + self.duration)
+
+    def is_free(self, index, start, ignore=None):
+        """Checks whether everyone in a meeting is free at the given start, except for meeting `ignore`."""
+        for person in self.panels[index]:
+            busy = self.busy[person]
+            for hour in self.hours(start):
+                owner = busy.get(hour)
+                if owner is not None and owner != ignore:
+                    return False
+        return True
+
+    def place(self, index, start):
+        """Assigns a start to a meeting, and removes the overlapping starts of the pending meetings that share people."""
+        self.assignment[index] = start
+        for person in self.panels[index]:
+            for hour in self.hours(start):
+                self.busy[person][hour] = index
+        for other in self.neighbours[index] & self.pending:
+            domain = self.domains[other]
+            size = len(domain)
+            for overlapping in range(start - self.duration + 1, start + self.duration):
+                domain.discard(overlapping)
+            # Meetings whose options did not change keep their place in the queue
+            if len(domain) != size:
+                heapq.heappush(self.queue, (len(domain), other))
+
+    def remove(self, index):
+        """Unassigns a meeting, and gives back the freed starts to the pending meetings that share people."""
+        start = self.assignment[index]
+        self.assignment[index] = None
+        for person in self.panels[index]:
+            for hour in self.hours(start):
+                del self.busy[person][hour]
+        for other in self.neighbours[index] & self.pending:
+            domain = self.domains[other]
+            for overlapping in range(start - self.duration + 1, start + self.duration):
+                if overlapping not in domain and overlapping in self.options[other] and \
+                        self.is_free(other, overlapping):
+                    domain.add(overlapping)
+            heapq.heappush(self.queue, (len(domain), other))
+
+    def repair(self, index):
+        """Tries to place a meeting without options by moving the only meeting that blocks one of its starts.
+
+        Returns
+        -------
+        bool
+            Whether the meeting was placed.
+        """
+        for start in self.candidates[index]:
+            self.budget -= 1
+            if self.budget < 0:
+                return False
+            blockers = set(self.busy[person][hour] for person in self.panels[index] for hour in self.hours(start)
+                           if hour in self.busy[person])
+            if len(blockers) != 1:
+                continue
+            blocker = blockers.pop()
+            for alternative in self.candidates[blocker]:
+                self.budget -= 1
+                if self.budget < 0:
+                    return False
+                # The blocker shares people with the meeting, so it cannot overlap the freed hours either
+                if abs(alternative - start) < self.duration:
+                    continue
+                if self.is_free(blocker, alternative, ignore=blocker):
+                    self.remove(blocker)
+                    self.place(blocker, alternative)
+                    self.place(index, start)
+                    return True
+        return False
+
+    def solve(self):
+        """Assigns a start to as many meetings as possible.
+
+        Returns
+        -------
+        list(int)
+            The first hour (since the epoch) of every meeting, or None for meetings that could not be placed.
+        """
+        while self.queue:
+            size, index = heapq.heappop(self.queue)
+            if index not in self.pending or size != len(self.domains[index]):
+                # Stale entry: the meeting was already handled, or its options changed since it was queued
+                continue
+            self.pending.discard(index)
+            if size > 0:
+                self.place(index, min(self.domains[index]))
+            elif self.budget > 0:
+                self.repair(index)
+        return list(self.assignment)
+
+
+def assign_meetings(panels, available, duration=1, repair_limit=REPAIR_LIMIT):
+    """Assigns non-overlapping hours to a batch of meetings. See `MeetingScheduler` for the parameters.
+
+    Returns
+    -------
+    list(int)
+        The first hour (since the epoch) of every meeting, or None for meetings that could not be placed.
+    """
+    return MeetingScheduler(panels, available, duration, repair_limit).solve()
+
+
+class TestCaseScheduler(unittest.TestCase):
+    """Checks that assignments never overlap, and compares them against an exhaustive search on small batches."""
+    def check_assignment(self, panels, available, duration, assignment):
+        busy = set()
+        for panel, slots, start in zip(panels, available, assignment):
+            if start is None:
+                continue
+            self.assertEqual(slots.clip(start, start + duration).count(), duration,
+                             'A meeting was placed outside of its available hours')
+            for person in panel:
+                for hour in range(start, start + duration):
+                    self.assertNotIn((person, hour), busy, 'Two meetings of {} overlap'.format(person))
+                    busy.add((person, hour))
+
+    @staticmethod
+    def best_count(panels, available, duration):
+        # Reference implementation: the largest number of meetings that can be placed, trying every combination
+        options = [[None] + [hour for range_from, range_to in slots for hour in range(range_from, range_to - duration + 1)]
+                   for slots in available]
+        best = 0
+        for assignment in itertools.product(*options):
+            busy = set()
+            valid = True
+            for panel, start in zip(panels, assignment):
+                if start is None:
+                    continue
+                hours = set((person, hour) for person in panel for hour in range(start, start + duration))
+                if not busy.isdisjoint(hours):
+                    valid = False
+                    break
+                busy |= hours
+            if valid:
+                best = max(best, sum(start is not None for start in assignment))
+        return best
+
+    def testRepair(self):
+        # Every meeting has two options, so the first one takes hour 3, which is the only one left for the last
+        # meeting once the second one takes hour 2. Moving the first meeting to hour 4 makes room for it.
+        panels = [('x', 'y'), ('x', 'y'), ('x',)]
+        available = [SlotSet.from_ranges([(3, 5)]), SlotSet.from_ranges([(2, 4)]), SlotSet.from_ranges([(2, 4)])]
+        self.assertEqual(assign_meetings(panels, available, repair_limit=0), [3, 2, None])
+        self.assertEqual(assign_meetings(panels, available), [4, 2, 3])
+        # Four meetings of 'x' do not fit in three hours
+        assignment = assign_meetings(panels + [('x',)], available + [SlotSet.from_ranges([(3, 4)])])
+        self.assertEqual(assignment.count(None), 1, 'Meetings without free hours should be reported as unplaced')
+
+    def testRandomized(self):
+        rng = random.Random(11)
+        people = ['p{}'.format(i) for i in range(5)]
+        for _ in range(40):
+            duration = rng.randint(1, 2)
+            panels = [tuple(rng.sample(people, rng.randint(1, 3))) for _ in range(rng.randint(2, 5))]
+            available = []
+            for _ in panels:
+                start = rng.randint(0, 4)
+                available.append(SlotSet.from_ranges([(start, start + rng.randint(1, 3)),
+                                                      (start + 5, start + 5 + rng.randint(0, 2))]))
+            assignment = assign_meetings(panels, available, duration)
+            self.check_assignment(panels, available, duration, assignment)
+            placed = sum(start is not None for start in assignment)
+            # The heuristic is not exact, but it should rarely miss by more than one meeting on batches this small
+            self.assertGreaterEqual(placed, self.best_count(panels, available, duration) - 1)
+
+    def testOverbooked(self):
+        # Hundreds of interviews over a few thousand interviewer-hours, with more interviews than fit
+        rng = random.Random(5)
+        interviewers = ['i{}'.format(i) for i in range(10)]
+        hours = dict()
+        for person in interviewers:
+            ranges = []
+            end = 0
+            while sum(range_to - range_from for range_from, range_to in ranges) < 120:
+                start = end + rng.randint(0, 3)
+                end = start + rng.randint(2, 8)
+                ranges.append((start, end))
+            hours[person] = SlotSet.from_ranges(ranges)
+        panels, available = [], []
+        for candidate in range(600):
+            panel = rng.sample(interviewers, rng.randint(2, 3))
+            panels.append(tuple(['c{}'.format(candidate)] + panel))
+            available.append(hours[panel[0]].intersection(*[hours[person] for person in panel[1:]]))
+        started = time.perf_counter()
+        assignment = assign_meetings(panels, available)
+        elapsed = time.perf_counter() - started
+        self.check_assignment(panels, available, 1, assignment)
+        self.assertIn(None, assignment, 'The batch should not fit')
+        self.assertLess(elapsed, 1.0, 'Unplaced meetings should not make the batch take longer than a second')
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
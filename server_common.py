@@ -0,0 +1,224 @@
+#!/usr/bin/python3
+
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from backend import CalendarPool
+from datecodec import parse_date
+from meeting_cache import MeetingCache
+from snapshot import SnapshotLog
+from metrics import METRICS
+
+# Configuration shared by all the servers, read from the environment
+DATABASE = os.environ.get('CALENDAR_DATABASE', 'database.db')
+# SQLite tuning. WAL allows readers to keep working while another connection writes
+PRAGMAS = {
+    'journal_mode': os.environ.get('CALENDAR_JOURNAL_MODE', 'wal'),
+    'synchronous': os.environ.get('CALENDAR_SYNCHRONOUS', 'normal'),
+    'cache_size': int(os.environ.get('CALENDAR_CACHE_SIZE', -16000)),
+    'mmap_size': int(os.environ.get('CALENDAR_MMAP_SIZE', 64*1024*1024)),
+}
+# Maximum number of database connections kept open, and therefore of requests that use the database at once
+POOL_SIZE = int(os.environ.get('CALENDAR_POOL_SIZE', 8))
+MEETING_CACHE_SIZE = int(os.environ.get('CALENDAR_MEETING_CACHE_SIZE', 1024))
+MEETING_CACHE_TTL = float(os.environ.get('CALENDAR_MEETING_CACHE_TTL', 60))
+# Serve reads from an in-memory copy of the database, refreshed every few seconds with the changes of other processes
+SNAPSHOT = os.environ.get('CALENDAR_SNAPSHOT', '').lower() in ('1', 'true', 'yes')
+SNAPSHOT_REFRESH = float(os.environ.get('CALENDAR_SNAPSHOT_REFRESH', 5))
+# Number of processes used to calculate batches of meetings (0 = calculate them in the request thread)
+BATCH_WORKERS = int(os.environ.get('CALENDAR_BATCH_WORKERS', 0))
+# Request metrics, exported at /metrics. Setting a slow-call threshold (in milliseconds) also enables them
+METRICS_ENABLED = os.environ.get('CALENDAR_METRICS', '').lower() in ('1', 'true', 'yes')
+SLOW_CALL_MS = os.environ.get('CALENDAR_SLOW_CALL_MS')
+# Content type of the Prometheus text format
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def create_pool(size=POOL_SIZE):
+    """Creates the pool of calendars used by a server.
+
+    Connections are reused across requests, and the schema is only set up here. Results of meeting
+    queries are cached until a participant changes or the entry expires. If enabled, every connection
+    reads from its own in-memory snapshot of the database.
+    """
+    meeting_cache = MeetingCache(maxsize=MEETING_CACHE_SIZE, ttl=MEETING_CACHE_TTL)
+    snapshot = None
+    if SNAPSHOT:
+        snapshot = SnapshotLog(refresh=SNAPSHOT_REFRESH if SNAPSHOT_REFRESH > 0 else None)
+    return CalendarPool(DATABASE, PRAGMAS, meeting_cache, snapshot, size)
+
+
+def configure_metrics():
+    """Enables the metrics of the process and the slow-call log, if the environment asks for them."""
+    METRICS.configure(METRICS_ENABLED, float(SLOW_CALL_MS) / 1000 if SLOW_CALL_MS else None)
+
+
+def create_batch_executor():
+    """Creates the process pool used to calculate batches of meetings, or returns None if it is disabled."""
+    if BATCH_WORKERS > 0:
+        return ProcessPoolExecutor(max_workers=BATCH_WORKERS)
+    return None
+
+
+def parse_window(args):
+    """Reads the optional `start` and `end` query parameters of a request.
+
+    Parameters
+    ----------
+    args : mapping
+        The query parameters of the request.
+
+    Returns
+    -------
+    tuple(datetime, datetime)
+        The start and the end of the window. Missing parameters are returned as None.
+
+    Raises
+    ------
+    ValueError
+        If one of the parameters is not a valid date.
+    """
+    window = []
+    for param in ('start', 'end'):
+        value = args.get(param)
+        date = parse_date(value)
+        if value is not None and date is None:
+            raise ValueError('Wrong date for parameter {}'.format(param))
+        window.append(date)
+    return tuple(window)
+
+
+def wants_stream(args):
+    """Returns whether a request asked for a streamed response with the `stream` query parameter."""
+    return args.get('stream', '').lower() in ('1', 'true', 'yes')
+
+
+def parse_meeting_options(args):
+    """Reads the optional `format`, `limit`, and `min_hours` query parameters of a meeting request.
+
+    Returns
+    -------
+    dict
+        The keyword arguments for `Calendar.organize_meeting`.
+
+    Raises
+    ------
+    ValueError
+        If `limit` or `min_hours` are not integers.
+    """
+    options = {'fmt': args.get('format', 'hours'), 'min_hours': parse_int(args.get('min_hours', 1))}
+    if args.get('limit') is not None:
+        options['limit'] = parse_int(args.get('limit'))
+    return options
+
+
+def parse_int(value):
+    """Converts a parameter to an integer, raising ValueError for any value that is not one.
+
+    Only integers and strings of digits (with an optional sign) are accepted, so that JSON numbers with
+    decimals and booleans are not silently truncated.
+    """
+    if isinstance(value, str) and re.fullmatch('[+-]?[0-9]+', value):
+        return int(value)
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    raise ValueError('Wrong integer: {!r}'.format(value))
+
+
+def parse_meetings(body):
+    """Converts the body of a request for many meetings into the parameters of `Calendar.organize_meetings`.
+
+    The body is a JSON object with a list `meetings` of objects with the fields `interviewee` and `interviewers`.
+    It can also have the fields `start`, `end`, `format`, `limit`, and `min_hours`, which apply to all meetings.
+
+    Returns
+    -------
+    tuple(list, dict)
+        The list of meetings, and the rest of the keyword arguments.
+
+    Raises
+    ------
+    ValueError
+        If the body does not have the expected fields.
+    """
+    meetings = meeting_list(body)
+    options = parse_meeting_options(body)
+    options['start'], options['end'] = parse_window(body)
+    return meetings, options
+
+
+def parse_schedule(body):
+    """Converts the body of a scheduling request into the parameters of `Calendar.schedule_meetings`.
+
+    The body has the same list of `meetings` as in `parse_meetings`, and the optional fields `start`, `end`,
+    and `duration` (in hours).
+
+    Returns
+    -------
+    tuple(list, dict)
+        The list of meetings, and the rest of the keyword arguments.
+
+    Raises
+    ------
+    ValueError
+        If the body does not have the expected fields, or `duration` is not an integer.
+    """
+    meetings = meeting_list(body)
+    options = {'duration': parse_int(body.get('duration', 1))}
+    options['start'], options['end'] = parse_window(body)
+    return meetings, options
+
+
+def meeting_list(body):
+    """Reads the list of meetings of a request body, as (interviewee, interviewers) pairs."""
+    if not isinstance(body, dict) or not isinstance(body.get('meetings'), list):
+        raise ValueError('Wrong list of meetings')
+    return [(row.get('interviewee'), row.get('interviewers')) if isinstance(row, dict) else None
+            for row in body['meetings']]
+
+
+def batch_rows(body):
+    """Converts the body of a batch request into the parameters of `add_users_bulk` and `add_slots_bulk`.
+
+    The body is a JSON object with the optional lists `people` (objects with the fields `user_id` and `name`)
+    and `slots` (objects with the fields `user_id`, `from` and `to`). Rows that are not objects, or whose dates
+    are not valid, are kept as invalid rows so that their errors are reported at the right position.
+
+    Returns
+    -------
+    tuple(list, list)
+        The rows of people and the rows of slots.
+
+    Raises
+    ------
+    ValueError
+        If the body is not an object, or `people` or `slots` are not lists.
+    """
+    if not isinstance(body, dict):
+        raise ValueError('Wrong batch')
+    for field in ('people', 'slots'):
+        if not isinstance(body.get(field, []), list):
+            raise ValueError('Wrong list of {}'.format(field))
+    people = [(row.get('user_id'), row.get('name')) if isinstance(row, dict) else None
+              for row in body.get('people', [])]
+    slots = [(row.get('user_id'), parse_date(row.get('from')), parse_date(row.get('to')))
+             if isinstance(row, dict) else None
+             for row in body.get('slots', [])]
+    return people, slots
+
+
+def add_batch(cal, people, slots):
+    """Adds the rows of a batch request (see `batch_rows`), people first so they can get slots in the same request.
+
+    Returns
+    -------
+    dict
+        A dictionary containing the fields `code`, `desc`, `people`, and `slots`. The last two fields are the
+        return values of `add_users_bulk` and `add_slots_bulk`.
+    """
+    retval = {'code': 0, 'desc': 'Operation successful',
+              'people': cal.add_users_bulk(people), 'slots': cal.add_slots_bulk(slots)}
+    if retval['people']['code'] != 0 or retval['slots']['code'] != 0:
+        retval['code'] = 1
+        retval['desc'] = 'Some rows could not be added'
+    return retval
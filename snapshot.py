@@ -0,0 +1,133 @@
+#!/usr/bin/python3
+
+import threading
+import time
+import unittest
+from collections import deque
+
+
+class SnapshotLog:
+    """Log of the changes committed through a pool, so that in-memory snapshots of the database can catch up.
+
+    Every transaction that changes any data increments the change counter of the database (see
+    `Calendar.count_change`), and the calendars of the pool record the users it modified under the new value
+    of the counter. A snapshot remembers the value of the counter it is up to date with, and asks for the
+    users modified since then (see `since`).
+
+    Other processes increment the same counter, but their changes are not in the log. They show up as gaps
+    between the values in the log, and snapshots that see one are reloaded entirely. Only the latest `maxsize`
+    changes are kept, and snapshots that fall further behind are also reloaded.
+
+    Notes
+    -----
+    Snapshots only notice the changes made by other processes once a change of this process is recorded
+    after them, or when they read the counter of the database, which they do every `refresh` seconds.
+
+    All methods are thread-safe.
+    """
+    def __init__(self, maxsize=10000, refresh=5.0, clock=time.monotonic):
+        """Initializes the log.
+
+        Parameters
+        ----------
+        maxsize : int, optional
+            The maximum number of changes kept in the log.
+        refresh : float, optional
+            The number of seconds between two checks for changes made by other processes, or None to never
+            check for them.
+        clock : callable, optional
+            Function returning the current time in seconds. Only meant to be replaced by tests.
+        """
+        self.refresh = refresh
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.latest = 0
+        self.changes = deque(maxlen=maxsize)
+        self.counters = {'changes': 0, 'updates': 0, 'reloads': 0}
+
+    def record(self, user_id, change):
+        """Records that the data of a user was changed by the committed transaction with the given counter value.
+
+        A user_id of None means that anything may have changed.
+        """
+        with self.lock:
+            self.changes.append((change, user_id))
+            self.latest = max(self.latest, change)
+            self.counters['changes'] += 1
+
+    def since(self, change, latest=None):
+        """Returns the users modified after a value of the change counter.
+
+        Parameters
+        ----------
+        change : int
+            The value of the counter the snapshot is up to date with.
+        latest : int, optional
+            The current value of the counter in the database. By default, the latest value in the log.
+
+        Returns
+        -------
+        tuple(int, set)
+            The value of the counter the snapshot is up to date with once the users are copied again, and the
+            users modified since `change`. The set is None if the snapshot must be reloaded entirely, because
+            some of those changes are not in the log (they were made by another process, or they are too old)
+            or one of them was not limited to a single user.
+        """
+        with self.lock:
+            if latest is None:
+                latest = self.latest
+            if latest <= change:
+                return change, set()
+            users = set()
+            found = set()
+            # Changes are recorded roughly in order, so the search stops at the first one the snapshot has.
+            # Changes recorded out of order before it are missed, which only causes a reload.
+            for recorded, user_id in reversed(self.changes):
+                if recorded <= change:
+                    break
+                if recorded > latest:
+                    continue
+                if user_id is None:
+                    return latest, None
+                found.add(recorded)
+                users.add(user_id)
+            if len(found) < latest - change:
+                return latest, None
+            return latest, users
+
+    def count(self, kind):
+        """Adds one to the number of incremental 'updates' or full 'reloads' of the snapshots."""
+        with self.lock:
+            self.counters[kind] += 1
+
+    def stats(self):
+        """Returns the number of recorded changes, and of incremental updates and full reloads of the snapshots."""
+        with self.lock:
+            return dict(self.counters, latest=self.latest)
+
+
+class TestCaseSnapshotLog(unittest.TestCase):
+    """Tests the changes returned to snapshots that are behind the log."""
+    def testSince(self):
+        log = SnapshotLog(maxsize=4)
+        self.assertEqual(log.since(0), (0, set()))
+        log.record('manager1', 1)
+        log.record('manager2', 2)
+        log.record('manager3', 2)
+        log.record('manager1', 3)
+        self.assertEqual(log.since(0), (3, {'manager1', 'manager2', 'manager3'}))
+        self.assertEqual(log.since(2), (3, {'manager1'}))
+        self.assertEqual(log.since(3), (3, set()))
+        self.assertEqual(log.since(2, latest=3), (3, {'manager1'}), 'Changes in the log should not reload')
+        self.assertEqual(log.since(2, latest=4), (4, None), 'Changes of other processes should reload')
+        log.record('manager2', 5)
+        self.assertEqual(log.since(3), (5, None), 'Gaps between recorded changes should reload')
+        self.assertEqual(log.since(0), (5, None), 'Snapshots behind the log should be reloaded')
+        log.record(None, 6)
+        self.assertEqual(log.since(5), (6, None), 'Changes to every user should reload the snapshots')
+        log.count('reloads')
+        self.assertEqual(log.stats(), {'changes': 6, 'updates': 0, 'reloads': 1, 'latest': 6})
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)